@@ -1,14 +1,19 @@
-from flask import Blueprint, g, abort, request, render_template, flash, redirect, url_for
+from flask import Blueprint, g, abort, request, render_template, flash, redirect, url_for, jsonify
 from flask_paginate import Pagination
 from playhouse.flask_utils import get_object_or_404
 
 from admin.forms import AdminCharacterForm, AdminMailForm, AdminUniverseForm
 from admin.utils import delete_live_character_completely, delete_live_universe_completely, strike_or_ban_user, \
     delete_universe_if_no_characters_left, delete_old_ratings_and_create_new_ones, _create_new_ratings
+from characters.live_search import LIVE_SEARCH_INDEX
+from characters.search_cache import SEARCH_CACHE
+from characters.universe_directory import UNIVERSE_DIRECTORY
+from characters.ratings import mark_universe_changed, subtract_votes_from_totals
 from mails import send_mails_globally
 from main import limiter, app
 from models import CharacterTemp, Character, delete_image, upload_image, upload_old_image, CharacterTempPicture, \
-    CharacterPicture, DataError, Universe, fn, Category, IntegrityError, CategoryRating, GlobalRating
+    CharacterPicture, DataError, Universe, fn, Category, IntegrityError, CategoryRating, GlobalRating, DATABASE, \
+    CategoryRelationship
 from utils import decode_char_hashid, create_char_hashid, create_pic_hashid, resize_image, decode_pic_hashid
 
 admin = Blueprint('admin', __name__, url_prefix='/admin')
@@ -56,6 +61,12 @@ def strike_user_by_temp_character(hashid, user_id: int):
     return redirect(url_for('admin.approve_character', hashid=create_char_hashid(character_id, extra_salt=app.config['CHARACTER_TEMP'])))
 
 
+@admin.route('/search_cache', methods=('GET',))
+def search_cache_stats():
+    # For tuning the size and TTL of the search cache, look in characters/search_cache.py.
+    return jsonify(SEARCH_CACHE.stats())
+
+
 @admin.route('/mail', methods=('GET', 'POST'))
 @limiter.limit('15/minute')
 def mail():
@@ -117,15 +128,19 @@ def edit_universe(universe_name: str):
                                    extra_errors="Please don't provide any duplicate categories. ")
         # Update the database by deleting deleted categories.
         try:
-            Category.delete().where((Category.id.not_in(
+            deleted_categories = Category.select(Category.id).where((Category.id.not_in(
                 [int(category_form['category_id']) for category_form in form.categories.data if
-                 category_form['category_id']])) & (Category.universe == universe)).execute()
+                 category_form['category_id']])) & (Category.universe == universe))
         # Users can change the value of the html hidden input field to something that is not "int()" passable.
         # I only need to check it here since this is the first time I'm checking for it and I'm going to check for EVERY
         # single category_id
         except ValueError:
             return render_template('admin/edit_universe.html', universe=universe_name, form=form,
                                    extra_errors="Please don't change the value of the hidden html input fields id(s)! ")
+        with DATABASE.transaction():
+            # The votes of the deleted categories are deleted with them, so they have to leave the vote totals too.
+            subtract_votes_from_totals(CategoryRelationship.category.in_(deleted_categories))
+            Category.delete().where(Category.id.in_(deleted_categories)).execute()
         # Update the database by updating the previous (old) categories with the new inputted names.
         for category_form in form.categories.data:
             try:
@@ -140,21 +155,27 @@ def edit_universe(universe_name: str):
         form_data_set = {category_form['category'].lower() for category_form in form.categories.data}
         model_data_set = {category.name.lower() for category in universe.categories}
         # Update the database by creating the newly made categories.
+        new_categories = []
         for category in form_data_set - model_data_set:
             # Checking if the category form data is not an emtpy string (emtpy user input).
             if category:
                 # Create the new categories
-                category = Category.create_category(universe=universe, name=category.title())
-                # Then create a new categoryRating row with that specific "category" for every character.
-                for character in universe.characters:
-                    CategoryRating.create_category_rating(character=character, category=category)
+                new_categories.append(Category.create_category(universe=universe, name=category.title()))
+        if new_categories:
+            # Then create a new categoryRating row with every new category for every character, all in one go.
+            characters = list(universe.characters.select(Character.id))
+            CategoryRating.create_category_ratings([{'character': character, 'category': category}
+                                                    for category in new_categories for character in characters])
+        # Deleted categories takes their votes with them, so the whole universe has to be recomputed.
+        mark_universe_changed(universe.id)
         if form.universe.data.lower() != universe_name.lower():
             if Universe.select().where(fn.lower(Universe.name) == form.universe.data.lower()).exists():
                 form.universe.errors.append(f"The universe {form.universe.data} already exists. ")
                 return render_template('admin/edit_universe.html', universe=universe_name, form=form)
-            Universe.update(
-                {Universe.name: form.universe.data, Universe.search_name: fn.to_tsvector(form.universe.data)}).where(
-                Universe.name == universe_name).execute()
+            Universe.update({Universe.name: form.universe.data}).where(Universe.name == universe_name).execute()
+            LIVE_SEARCH_INDEX.refresh_universes([universe.id])
+            UNIVERSE_DIRECTORY.invalidate()
+            SEARCH_CACHE.clear()
         flash(message="Universe updated. Let's hope they get happy, am i right? :)", category="success")
         return redirect(url_for('characters.render_universe_characters', universe_name=form.universe.data))
     return render_template('admin/edit_universe.html', universe=universe_name, form=form)
@@ -200,6 +221,7 @@ def approve_character(hashid):
                     return render_template('admin/approve_character.html', form=form, character=first_character,
                                            extra_errors="Please provide at least one category for the new universe. ")
                 universe = Universe.create_universe(name=form.universe.data)
+                UNIVERSE_DIRECTORY.invalidate()
                 for category in {category.lower() for category in form.categories.data}:
                     if category:
                         Category.create_category(universe=universe, name=category.title())
@@ -230,6 +252,9 @@ def approve_character(hashid):
         Character.update({Character.character_picture: picture_url}) \
             .where(Character.id == new_character.id).execute()
         _create_new_ratings(new_character, universe)
+        LIVE_SEARCH_INDEX.refresh_universes([universe.id])
+        LIVE_SEARCH_INDEX.refresh_characters([new_character.id])
+        SEARCH_CACHE.clear()
         delete_image(first_character.character_picture)
         first_character.delete_instance()
         flash(message="Released to the public, this is exciting stuff!", category="success")
@@ -269,6 +294,7 @@ def edit_character(hashid):
                     return render_template('admin/edit_character.html', form=form, character=live_character,
                                            extra_errors="Please provide at least one category for the new universe. ")
                 universe = Universe.create_universe(name=form.universe.data)
+                UNIVERSE_DIRECTORY.invalidate()
                 for category in form.categories.data:
                     if category:
                         Category.create_category(universe=universe, name=category.title())
@@ -278,7 +304,6 @@ def edit_character(hashid):
                 return render_template('admin/edit_character.html', form=form, character=live_character)
         Character.update({
             Character.name: form.name.data,
-            Character.search_name: fn.to_tsvector(form.name.data),
             Character.universe: universe,
             Character.age: form.age.data,
             Character.height: form.height.data,
@@ -289,18 +314,25 @@ def edit_character(hashid):
             Character.status: form.status.data,
             Character.description: form.description.data,
             Character.official: form.official.data == 'True',
-        }).where(Character.id == live_character.id).execute()
+        }, **Character.numeric_attribute_columns(age=form.age.data, height=form.height.data, weight=form.weight.data)).where(
+            Character.id == live_character.id).execute()
         if live_character.universe != universe:
             delete_old_ratings_and_create_new_ones(live_character, universe)
         else:
             # delete the old global rank values if the character has been set to be unofficial.
             if form.official.data == 'False' and live_character.official:
+                # The staged ones too, otherwise the next ratings job would publish the old ones again.
                 GlobalRating.update({
-                    GlobalRating.global_rank: None
+                    GlobalRating.global_rank: None,
+                    GlobalRating.next_global_rank: None
                 }).where(GlobalRating.character == live_character).execute()
                 CategoryRating.update({
-                    CategoryRating.global_category_rank: None
+                    CategoryRating.global_category_rank: None,
+                    CategoryRating.next_global_category_rank: None
                 }).where(CategoryRating.character == live_character).execute()
+            # an official character changes the global ranks of everybody else, and the leaderboards show the name,
+            # picture and occupation too, so they have to be refreshed after any edit.
+            mark_universe_changed(universe.id)
         delete_universe_if_no_characters_left(live_character.universe)  # retrieve old universe and then maybe delete it
         if form.character_picture.data:
             resized_img = resize_image(width=330, height=380, image_file=request.files['character_picture'])
@@ -308,6 +340,10 @@ def edit_character(hashid):
                 live_character.id, extra_salt=app.config['CHARACTER_LIVE_PIC']))
             Character.update({Character.character_picture: picture_url}).where(
                 Character.id == live_character.id).execute()
+        # The old universe might have been deleted above, and the universe might be a new one.
+        LIVE_SEARCH_INDEX.refresh_universes([universe.id])
+        LIVE_SEARCH_INDEX.refresh_characters([live_character.id])
+        SEARCH_CACHE.clear()
         flash(message="Character updated. Let's hope they get happy, am i right? :)", category="success")
         return redirect(url_for('characters.character', hashid=create_char_hashid(live_character.id, extra_salt=app.config['CHARACTER'])))
     return render_template('admin/edit_character.html', form=form, character=live_character)
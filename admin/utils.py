@@ -2,10 +2,15 @@ from threading import Thread
 
 from flask import flash
 from playhouse.flask_utils import get_object_or_404
+from characters.live_search import LIVE_SEARCH_INDEX
+from characters.search_cache import SEARCH_CACHE
+from characters.universe_directory import UNIVERSE_DIRECTORY
+from characters.utils import forget_comment_users
+from characters.ratings import mark_universe_changed, mark_votes_of_user_changed, subtract_votes_from_totals
 from main import app
 from mails import send_ban_mail
 
-from models import User, Universe, delete_image, GlobalRating, CategoryRating, fn, CategoryRelationship, Comment, Ping, CommentRelationship
+from models import DATABASE, User, Universe, delete_image, GlobalRating, CategoryRating, fn, CategoryRelationship, Comment, Ping, CommentRelationship
 
 
 def _delete_all_associated_character_pictures(live_character):
@@ -34,18 +39,27 @@ def _delete_live_character(live_character):
     # I'm not calling the "get_or_none()" function, since i know for sure that the universe exist.
     universe = Universe.select().where(Universe.name == live_character.universe.name).get()
     live_character.delete_instance()
+    LIVE_SEARCH_INDEX.refresh_characters([live_character.id])
+    mark_universe_changed(universe.id)
     delete_universe_if_no_characters_left(universe)
+    SEARCH_CACHE.clear()
 
 
 def _delete_live_universe(live_universe):
     for character in live_universe.characters:
         _delete_all_associated_character_pictures(character)
     live_universe.delete_instance()
+    LIVE_SEARCH_INDEX.refresh_universes([live_universe.id])
+    UNIVERSE_DIRECTORY.invalidate()
+    mark_universe_changed(live_universe.id)
+    SEARCH_CACHE.clear()
 
 
 def delete_universe_if_no_characters_left(universe: Universe):
     if not universe.characters.exists():
         universe.delete_instance()
+        LIVE_SEARCH_INDEX.refresh_universes([universe.id])
+        UNIVERSE_DIRECTORY.invalidate()
 
 
 def delete_old_ratings_and_create_new_ones(live_character, universe):
@@ -55,12 +69,17 @@ def delete_old_ratings_and_create_new_ones(live_character, universe):
     CategoryRelationship.delete().where(CategoryRelationship.character == live_character).execute()
     # create the new ones
     _create_new_ratings(live_character, universe)
+    # both the old and the new universe have to be ranked again.
+    mark_universe_changed(live_character.universe_id)
+    mark_universe_changed(universe.id)
 
 
 def _create_new_ratings(character, universe):
-    GlobalRating.create_global_rating(character=character)
-    for category in universe.categories:
-        CategoryRating.create_category_rating(character=character, category=category)
+    GlobalRating.create_global_ratings([{'character': character}])
+    CategoryRating.create_category_ratings([{'character': character, 'category': category}
+                                            for category in universe.categories])
+    # So the character shows up on the leaderboards after the next ratings job.
+    mark_universe_changed(universe.id)
 
 
 def strike_or_ban_user(user_id: int):
@@ -79,8 +98,12 @@ def strike_or_ban_user(user_id: int):
             }).where(User.id == user_id).execute()
             Ping.delete().where(Ping.to_user == user).execute()
             Comment.delete().where(Comment.user == user).execute()
-            CommentRelationship.delete().where(CommentRelationship.from_user == user).execute()
-            CategoryRelationship.delete().where(CategoryRelationship.user == user).execute()
+            forget_comment_users()
+            CommentRelationship.delete_comment_relationships(CommentRelationship.from_user == user)
+            with DATABASE.transaction():
+                mark_votes_of_user_changed(user)
+                subtract_votes_from_totals(CategoryRelationship.user == user)
+                CategoryRelationship.delete().where(CategoryRelationship.user == user).execute()
             flash(message="User have been sucessfully striked, and now BANNED", category="success")
         else:
             flash(message="User have been sucessfully striked", category="success")
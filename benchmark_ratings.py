@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import time
+from datetime import datetime
+
+from peewee import chunked
+
+# The app has to be set up first, the models and the blueprints import each other through it.
+from main import app
+from characters.ratings import update_all_ratings, change_vote_totals, mark_rating_changed
+from config import DATABASE_NAME, MAX_CONNECTIONS, STALE_TIMEOUT
+from migrations import create_leaderboards, create_search_name_triggers
+from models import DATABASE, CharacterTemp, User, Character, Comment, CommentRelationship, Ping, \
+    CharacterTempPicture, CharacterPicture, Universe, Category, CategoryRelationship, CategoryTemp, GlobalRating, \
+    CategoryRating, RatingChange, RatingsJob
+
+# Seeds a throwaway database with made up universes, characters and votes, and then times the cron job of the ratings
+# at every size you give it. Run it like this: "python benchmark_ratings.py --database anime_benchmark".
+# The database has to exist already, and EVERYTHING in it gets deleted, so never point it at a real one!
+
+MODELS = [User, CharacterTemp, Character, Comment, CommentRelationship, Ping, CharacterTempPicture, CharacterPicture,
+          Universe, Category, CategoryRelationship, CategoryTemp, GlobalRating, CategoryRating, RatingChange,
+          RatingsJob]
+CATEGORY_NAMES = ['Strength', 'Intelligence', 'Will Power', 'Speed', 'Teamwork', 'Durability', 'Stamina', 'Agility']
+CRON_JOB_URL = '/cron/characters/update_ratings'
+BATCH_SIZE = 1000
+
+
+class StatementCounter:
+    """Counts every statement sent to the database, and how many rows the inserts, updates and deletes touched."""
+
+    def __init__(self, database):
+        self.queries = 0
+        self.rows_written = 0
+        execute_sql = database.execute_sql
+
+        def counting_execute_sql(sql, *args, **kwargs):
+            cursor = execute_sql(sql, *args, **kwargs)
+            self.queries += 1
+            if sql.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')) and cursor.rowcount > 0:
+                self.rows_written += cursor.rowcount
+            return cursor
+
+        database.execute_sql = counting_execute_sql
+
+    def reset(self):
+        self.queries = 0
+        self.rows_written = 0
+
+
+def seed(characters: int, characters_per_universe: int, categories_per_universe: int, votes_per_character: int,
+         users: int, rng: random.Random):
+    # The leaderboards are dropped together with the tables (cascade), so they have to be created again.
+    DATABASE.drop_tables(MODELS, cascade=True)
+    DATABASE.create_tables(MODELS)
+    create_leaderboards()
+    create_search_name_triggers()
+    now = datetime.now()
+    user_ids = _insert_many(User, [{'username': f'user {i}', 'email': f'user{i}@benchmark', 'password': 'benchmark',
+                                    'joined_at': now, 'current_log_in': now, 'email_confirmed': True}
+                                   for i in range(users)])
+    universe_ids = _insert_many(Universe, [{'name': f'Universe {i}'} for i in range(-(-characters // characters_per_universe))])
+    categories_of_universe = {}
+    for universe_id in universe_ids:
+        names = rng.sample(CATEGORY_NAMES, min(categories_per_universe, len(CATEGORY_NAMES)))
+        categories_of_universe[universe_id] = _insert_many(Category, [{'universe': universe_id, 'name': name}
+                                                                      for name in names])
+    universe_of_character = {}
+    for i in range(characters):
+        universe_of_character[i] = universe_ids[i // characters_per_universe]
+    character_ids = _insert_many(Character, [{'name': f'Character {i}', 'universe': universe_of_character[i], 'age': '1',
+                                              'height': '1', 'weight': '1', 'species': 'Human', 'gender': 'Male',
+                                              'occupation': '-', 'status': 'Alive', 'description': '-',
+                                              'official': rng.random() < 0.7,
+                                              **Character.numeric_attribute_columns(age='1', height='1', weight='1')}
+                                             for i in range(characters)])
+    universe_of_character = {character_id: universe_of_character[i] for i, character_id in enumerate(character_ids)}
+    for batch in chunked(character_ids, BATCH_SIZE):
+        GlobalRating.create_global_ratings([{'character': character_id} for character_id in batch])
+        CategoryRating.create_category_ratings([{'character': character_id, 'category': category_id}
+                                                for character_id in batch
+                                                for category_id in
+                                                categories_of_universe[universe_of_character[character_id]]])
+    _insert_many(CategoryRelationship, [{'character': character_id, 'user': user_id, 'score': rng.randint(0, 100),
+                                         'category': rng.choice(categories)}
+                                        for character_id in character_ids
+                                        for categories in [categories_of_universe[universe_of_character[character_id]]]
+                                        for user_id in rng.sample(user_ids, min(votes_per_character, users))])
+    # This counts the vote totals from the votes too.
+    update_all_ratings()
+    return user_ids, categories_of_universe, universe_of_character
+
+
+def _insert_many(model, rows):
+    ids = []
+    with DATABASE.atomic():
+        for batch in chunked(rows, BATCH_SIZE):
+            ids += [row[0] for row in model.insert_many(batch).returning(model.id).tuples().execute()]
+    return ids
+
+
+def mark_everything_changed(universe_ids):
+    RatingChange.insert_many([{'universe_id': universe_id} for universe_id in universe_ids]).execute()
+
+
+def vote_on_some_characters(fraction: float, user_ids, categories_of_universe, universe_of_character,
+                            rng: random.Random):
+    # Votes just like the "rate" route does, on a random part of the characters.
+    character_ids = rng.sample(list(universe_of_character), max(1, int(len(universe_of_character) * fraction)))
+    with DATABASE.atomic():
+        for character_id in character_ids:
+            character = Character.get_by_id(character_id)
+            category = Category.get_by_id(rng.choice(categories_of_universe[character.universe_id]))
+            vote, created = CategoryRelationship.get_or_create(character=character, category=category,
+                                                              user=rng.choice(user_ids), defaults={'score': 0})
+            score = rng.randint(0, 100)
+            CategoryRelationship.update({CategoryRelationship.score: score}).where(
+                CategoryRelationship.id == vote.id).execute()
+            change_vote_totals(character, category, vote_count_difference=1 if created else 0,
+                               score_difference=score - vote.score)
+            mark_rating_changed(character, category)
+
+
+def time_cron_job(counter: StatementCounter):
+    # The cron job might need more than one request to finish the ratings job, all of them are counted.
+    DATABASE.close()
+    client = app.test_client()
+    counter.reset()
+    requests = 0
+    start = time.perf_counter()
+    while True:
+        response = client.get(CRON_JOB_URL, headers={'X-Appengine-Cron': 'true'})
+        requests += 1
+        if response.status_code != 200:
+            raise RuntimeError(f'The cron job failed with status code {response.status_code}')
+        if response.get_data(as_text=True) == 'It was a success!':
+            break
+    wall_time = time.perf_counter() - start
+    DATABASE.connect(reuse_if_open=True)
+    return {'wall_time': round(wall_time, 4), 'queries': counter.queries, 'rows_written': counter.rows_written,
+            'requests': requests}
+
+
+def compare(old_results, new_results):
+    old = {(result['characters'], result['scenario']): result for result in old_results['results']}
+    print(f"Compared to {old_results['commit'] or 'unknown commit'}:")
+    for result in new_results['results']:
+        old_result = old.get((result['characters'], result['scenario']))
+        if old_result:
+            change = (result['wall_time'] - old_result['wall_time']) / old_result['wall_time'] * 100
+            print(f"  {result['characters']:>9} characters, {result['scenario']:<11} {change:+7.1f}% wall time, "
+                  f"{result['queries'] - old_result['queries']:+d} queries, "
+                  f"{result['rows_written'] - old_result['rows_written']:+d} rows written")
+
+
+def _current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the cron job of the ratings with made up data.')
+    parser.add_argument('--database', required=True, help='a throwaway database, everything in it gets deleted')
+    parser.add_argument('--characters', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--characters-per-universe', type=int, default=50)
+    parser.add_argument('--categories-per-universe', type=int, default=4)
+    parser.add_argument('--votes-per-character', type=int, default=10)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--changed-fraction', type=float, default=0.01,
+                        help='how many of the characters get a vote before the incremental run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='an earlier results file to compare with')
+    args = parser.parse_args()
+    if args.database == DATABASE_NAME:
+        parser.error("That's the database of the website, please use a throwaway one instead.")
+
+    # The pool settings are passed along again, so the benchmark uses the same pool as the website.
+    DATABASE.init(args.database, max_connections=MAX_CONNECTIONS, stale_timeout=STALE_TIMEOUT)
+    counter = StatementCounter(DATABASE)
+    results = {'commit': _current_commit(), 'created': datetime.now().isoformat(timespec='seconds'),
+               'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+               'results': []}
+    for characters in args.characters:
+        rng = random.Random(args.seed)
+        DATABASE.connect(reuse_if_open=True)
+        user_ids, categories_of_universe, universe_of_character = seed(
+            characters, args.characters_per_universe, args.categories_per_universe, args.votes_per_character,
+            args.users, rng)
+        size = {'characters': characters, 'universes': len(categories_of_universe),
+                'votes': CategoryRelationship.select().count()}
+        vote_on_some_characters(args.changed_fraction, user_ids, categories_of_universe, universe_of_character, rng)
+        results['results'].append({**size, 'scenario': 'incremental', **time_cron_job(counter)})
+        mark_everything_changed(list(categories_of_universe))
+        results['results'].append({**size, 'scenario': 'full', **time_cron_job(counter)})
+        for result in results['results'][-2:]:
+            print(f"{result['characters']:>9} characters, {result['scenario']:<11} {result['wall_time']:9.3f}s "
+                  f"{result['queries']:>7} queries {result['rows_written']:>9} rows written "
+                  f"{result['requests']:>3} requests")
+        DATABASE.close()
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == '__main__':
+    main()
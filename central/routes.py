@@ -1,6 +1,7 @@
 from urllib.parse import urlparse, urlunparse
 
-from flask import Blueprint, request, redirect, g, render_template, url_for, flash
+from flask import Blueprint, request, redirect, g, render_template, url_for, flash, before_render_template, \
+    template_rendered
 from flask_login import current_user, logout_user
 
 from main import app
@@ -8,6 +9,10 @@ from models import DATABASE, Character, CategoryRelationship, GlobalRating, fn,
 
 central = Blueprint('central', __name__)
 
+# These templates get everything they show already fetched, in debug mode a query run while one of them is rendered raises
+# an error, so a lazy query (like calling .count() on a query in the template) can't sneak back in.
+MATERIALIZED_TEMPLATES = {'characters.html', 'search_suggestions.html'}
+
 
 @central.before_app_request
 def before_request():
@@ -35,8 +40,23 @@ def after_request(response):
     return response
 
 
+@before_render_template.connect_via(app)
+def forbid_queries_while_rendering(sender, template, context, **extra):
+    if app.debug and template.name in MATERIALIZED_TEMPLATES:
+        DATABASE.forbid_queries(f'The template "{template.name}" should only use data that has already been fetched')
+    else:
+        DATABASE.allow_queries()
+
+
+@template_rendered.connect_via(app)
+def allow_queries_after_rendering(sender, template, context, **extra):
+    DATABASE.allow_queries()
+
+
 @central.teardown_app_request
 def teardown_request(error):
+    # The template might have failed to render, and then the queries would still be forbidden for the next request.
+    DATABASE.allow_queries()
     if not DATABASE.is_closed():
         DATABASE.close()
 
@@ -46,7 +66,7 @@ def teardown_request(error):
 def home():
     most_voted_characters = Character.select().join(CategoryRelationship, JOIN.LEFT_OUTER).group_by(Character).order_by(-fn.COUNT(fn.DISTINCT(CategoryRelationship.user))).limit(8)
     recent_characters = Character.select().order_by(-Character.id).limit(8) 
-    top_unofficial_characters = Character.select().where(~Character.official).join(GlobalRating).order_by(-fn.to_number(GlobalRating.overall_score, '999G999')).order_by(GlobalRating.overall_score.desc(nulls='LAST')).limit(8)
+    top_unofficial_characters = Character.select().where(~Character.official).join(GlobalRating).order_by(GlobalRating.overall_score.desc(nulls='LAST')).limit(8)
     most_characters_universes = [universe[1] for universe in Universe.select().join(Character).group_by(Universe).order_by(-fn.COUNT(Character.universe)).limit(20).tuples()]
     recent_universes = [universe[1] for universe in Universe.select().order_by(-Universe.id).limit(20).tuples()]
     # "characters_and_universes_available=bool(most_voted_characters.count())" if this returns "True" then i know there must be at least one universe and one character.
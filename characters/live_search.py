@@ -0,0 +1,172 @@
+import re
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+from heapq import nsmallest
+from threading import Lock, Thread
+
+from models import DATABASE, Character, Universe, GlobalRating, JOIN
+
+# The autocomplete of the search bar is answered from these in memory indexes, instead of asking Postgres on every key
+# press. The admin routes update them when characters and universes are created, edited or deleted, but the ratings
+# change with the ratings job and there can be more than one instance of the website running, so they're also built
+# again from scratch when they're older than this (in seconds).
+LIVE_SEARCH_INDEX_TTL = 600
+
+IndexedCharacter = namedtuple('IndexedCharacter', ['id', 'name', 'picture', 'official', 'universe_id', 'global_rank',
+                                                   'overall_score'])
+IndexedUniverse = namedtuple('IndexedUniverse', ['id', 'name'])
+
+
+def normalize_words(text: str):
+    return re.findall(r'\w+', text.casefold())
+
+
+class PrefixIndex:
+    """Every word of every name is kept in one sorted list of (word, id) pairs, so all the names with a word starting
+    with some prefix are right next to each other and found with a binary search."""
+
+    def __init__(self, entries=()):
+        self._words = sorted((word, entry.id) for entry in entries for word in set(normalize_words(entry.name)))
+        self._entries = {entry.id: entry for entry in entries}
+
+    def add(self, entry):
+        self.remove(entry.id)
+        for word in set(normalize_words(entry.name)):
+            insort(self._words, (word, entry.id))
+        self._entries[entry.id] = entry
+
+    def remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry:
+            for word in set(normalize_words(entry.name)):
+                index = bisect_left(self._words, (word, entry_id))
+                if index < len(self._words) and self._words[index] == (word, entry_id):
+                    del self._words[index]
+
+    def entries(self):
+        return list(self._entries.values())
+
+    def search(self, query: str, limit: int):
+        # Every word of the query has to be the start of some word of the name, the oldest names come first.
+        matches = None
+        # The longest words first, since they usually match the fewest names.
+        for prefix in sorted(set(normalize_words(query)), key=len, reverse=True):
+            ids = set()
+            index = bisect_left(self._words, (prefix,))
+            while index < len(self._words) and self._words[index][0].startswith(prefix):
+                ids.add(self._words[index][1])
+                index += 1
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+        return [self._entries[entry_id] for entry_id in nsmallest(limit, matches)] if matches else []
+
+
+class LiveSearchIndex:
+    def __init__(self, ttl=LIVE_SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._characters = PrefixIndex()
+        self._universes = PrefixIndex()
+        self._built_at = None
+        # The ids refreshed while the indexes are being built, None when they aren't.
+        self._refreshed_while_building = None
+        self._lock = Lock()
+        self._rebuild_lock = Lock()
+
+    def rebuild(self):
+        # Only one thread builds the indexes, the others keep searching the old ones in the meantime.
+        if not self._rebuild_lock.acquire(blocking=False):
+            return
+        try:
+            self._build()
+        finally:
+            self._rebuild_lock.release()
+
+    def _build(self):
+        with self._lock:
+            self._refreshed_while_building = {'characters': set(), 'universes': set()}
+        characters = PrefixIndex(_load_characters())
+        universes = PrefixIndex(_load_universes())
+        with self._lock:
+            self._characters, self._universes = characters, universes
+            self._built_at = time.monotonic()
+            refreshed, self._refreshed_while_building = self._refreshed_while_building, None
+        # Those could have been loaded before they changed, and their refresh went to the old indexes, so they're
+        # refreshed again in the new ones.
+        if refreshed['universes']:
+            self.refresh_universes(refreshed['universes'])
+        if refreshed['characters']:
+            self.refresh_characters(refreshed['characters'])
+
+    def refresh_characters(self, character_ids):
+        characters = {character.id: character for character in _load_characters(character_ids)}
+        with self._lock:
+            if self._refreshed_while_building is not None:
+                self._refreshed_while_building['characters'].update(character_ids)
+            for character_id in character_ids:
+                if character_id in characters:
+                    self._characters.add(characters[character_id])
+                else:
+                    self._characters.remove(character_id)
+
+    def refresh_universes(self, universe_ids):
+        # The characters of a deleted universe are deleted with it.
+        universes = {universe.id: universe for universe in _load_universes(universe_ids)}
+        with self._lock:
+            if self._refreshed_while_building is not None:
+                self._refreshed_while_building['universes'].update(universe_ids)
+            for universe_id in universe_ids:
+                if universe_id in universes:
+                    self._universes.add(universes[universe_id])
+                else:
+                    self._universes.remove(universe_id)
+                    for character in self._characters.entries():
+                        if character.universe_id == universe_id:
+                            self._characters.remove(character.id)
+
+    def search_characters(self, query: str, limit: int):
+        self._rebuild_if_too_old()
+        with self._lock:
+            return self._characters.search(query, limit)
+
+    def search_universes(self, query: str, limit: int):
+        self._rebuild_if_too_old()
+        with self._lock:
+            return self._universes.search(query, limit)
+
+    def _rebuild_if_too_old(self):
+        if self._built_at is None:
+            # There's nothing to search yet, so every request waits for the first build, the one that gets the lock
+            # builds it.
+            with self._rebuild_lock:
+                if self._built_at is None:
+                    self._build()
+        elif time.monotonic() - self._built_at > self.ttl and not self._rebuild_lock.locked():
+            # The old indexes are searched until the new ones are swapped in, so no request waits for the build.
+            Thread(target=self._rebuild_in_background, name='live-search-rebuild', daemon=True).start()
+
+    def _rebuild_in_background(self):
+        # The thread has its own connection, which has to go back to the pool when it's done.
+        with DATABASE.connection_context():
+            self.rebuild()
+
+
+def _load_characters(character_ids=None):
+    characters = (Character
+                  .select(Character.id, Character.name, Character.character_picture, Character.official,
+                          Character.universe, GlobalRating.global_rank, GlobalRating.overall_score)
+                  .join(GlobalRating, JOIN.LEFT_OUTER))
+    if character_ids is not None:
+        characters = characters.where(Character.id.in_(list(character_ids)))
+    return [IndexedCharacter(*row) for row in characters.tuples()]
+
+
+def _load_universes(universe_ids=None):
+    universes = Universe.select(Universe.id, Universe.name)
+    if universe_ids is not None:
+        universes = universes.where(Universe.id.in_(list(universe_ids)))
+    return [IndexedUniverse(*row) for row in universes.tuples()]
+
+
+LIVE_SEARCH_INDEX = LiveSearchIndex()
@@ -0,0 +1,435 @@
+import time
+from multiprocessing import Pool
+
+from peewee import Expression
+
+from characters.utils import CATEGORY_NAMES
+from models import DATABASE, Universe, Character, Category, CategoryRelationship, GlobalRating, CategoryRating, \
+    RatingChange, RatingsJob, OverallLeaderboard, CategoryLeaderboard, fn, Case, JOIN, Tuple, Value
+
+# Here you can change the amount of people required to rate before actually calculating a score for a character.
+NUMBER_OF_REQUIRED_PEOPLE = 1  # must not be zero as that doesn't make sense.
+# How many seconds a single cron job request may work on the ratings job, the next request continues from there.
+RATINGS_JOB_TIME_BUDGET = 30
+# How many universes the ratings job goes through in one step (and one transaction).
+UNIVERSES_PER_STEP = 50
+RATINGS_JOB_PHASES = ['category_scores', 'overall_scores', 'universe_ranks', 'global_ranks', 'publish',
+                      'refresh_leaderboards']
+# The key of the Postgres advisory lock the ratings job with the worker processes holds for its whole run, the cron job
+# requests skip their steps while it's held.
+WORKER_RATINGS_JOB_LOCK = 2718
+
+
+class RatingChanges:
+    """The (character, category) pairs and universes that have to be recomputed, claimed from the "Rating_change"
+    table."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.pairs = {(character_id, category_id) for _, character_id, category_id in rows if character_id}
+        self.characters = {character_id for character_id, _ in self.pairs}
+        self.categories = {category_id for _, category_id in self.pairs}
+        self.universes = {universe_id for universe_id, _, _ in rows}
+        # Universes where something else than a vote happened (deleted characters, edited categories etc.).
+        self.whole_universes = {universe_id for universe_id, character_id, _ in rows if not character_id}
+
+    def __bool__(self):
+        return bool(self.universes)
+
+    def split_by_universe(self, parts: int):
+        # Every universe ends up in exactly one part, so no two parts ever touch the same rows.
+        universes = sorted(self.universes)
+        part_of_universe = {universe_id: index % parts for index, universe_id in enumerate(universes)}
+        split = [[] for _ in range(min(parts, len(universes)))]
+        for row in self.rows:
+            split[part_of_universe[row[0]]].append(row)
+        return split
+
+
+def mark_rating_changed(character, category):
+    RatingChange.create_rating_change(universe_id=character.universe_id, character_id=character.id,
+                                      category_id=category.id)
+
+
+def mark_universe_changed(universe_id: int):
+    RatingChange.create_rating_change(universe_id=universe_id)
+
+
+def mark_votes_of_user_changed(user):
+    # Has to be called BEFORE the votes of the user are deleted.
+    votes = (CategoryRelationship
+             .select(Character.universe, CategoryRelationship.character, CategoryRelationship.category, Value(False))
+             .join(Character)
+             .where(CategoryRelationship.user == user))
+    RatingChange.insert_from(votes, fields=[RatingChange.universe_id, RatingChange.character_id,
+                                            RatingChange.category_id, RatingChange.claimed]).execute()
+
+
+def change_vote_totals(character, category, vote_count_difference: int, score_difference: int):
+    # Has to be called inside the same transaction as the vote itself, so the totals never drift away from the votes.
+    CategoryRating.update({
+        CategoryRating.vote_count: CategoryRating.vote_count + vote_count_difference,
+        CategoryRating.score_sum: CategoryRating.score_sum + score_difference
+    }).where((CategoryRating.character == character) & (CategoryRating.category == category)).execute()
+    GlobalRating.update({
+        GlobalRating.vote_count: GlobalRating.vote_count + vote_count_difference,
+        GlobalRating.score_sum: GlobalRating.score_sum + score_difference
+    }).where(GlobalRating.character == character).execute()
+
+
+def subtract_votes_from_totals(condition):
+    # Takes away every vote matching the condition from the totals. Has to be called BEFORE the votes are deleted.
+    category_totals = (CategoryRelationship
+                       .select(CategoryRelationship.character, CategoryRelationship.category,
+                               fn.COUNT(CategoryRelationship.id).alias('vote_count'),
+                               fn.SUM(CategoryRelationship.score).alias('score_sum'))
+                       .where(condition)
+                       .group_by(CategoryRelationship.character, CategoryRelationship.category))
+    CategoryRating.update({
+        CategoryRating.vote_count: CategoryRating.vote_count - category_totals.c.vote_count,
+        CategoryRating.score_sum: CategoryRating.score_sum - category_totals.c.score_sum
+    }).from_(category_totals).where((CategoryRating.character == category_totals.c.character_id) &
+                                    (CategoryRating.category == category_totals.c.category_id)).execute()
+    character_totals = (CategoryRelationship
+                        .select(CategoryRelationship.character,
+                                fn.COUNT(CategoryRelationship.id).alias('vote_count'),
+                                fn.SUM(CategoryRelationship.score).alias('score_sum'))
+                        .where(condition)
+                        .group_by(CategoryRelationship.character))
+    GlobalRating.update({
+        GlobalRating.vote_count: GlobalRating.vote_count - character_totals.c.vote_count,
+        GlobalRating.score_sum: GlobalRating.score_sum - character_totals.c.score_sum
+    }).from_(character_totals).where(GlobalRating.character == character_totals.c.character_id).execute()
+
+
+def recount_vote_totals():
+    # Counts the totals again from the votes themselves, in case they ever got out of sync.
+    category_totals = (CategoryRating
+                       .select(CategoryRating.id, fn.COUNT(CategoryRelationship.id).alias('vote_count'),
+                               fn.COALESCE(fn.SUM(CategoryRelationship.score), 0).alias('score_sum'))
+                       .join(CategoryRelationship, JOIN.LEFT_OUTER,
+                             on=(CategoryRelationship.character == CategoryRating.character) &
+                                (CategoryRelationship.category == CategoryRating.category))
+                       .group_by(CategoryRating.id))
+    CategoryRating.update({
+        CategoryRating.vote_count: category_totals.c.vote_count,
+        CategoryRating.score_sum: category_totals.c.score_sum
+    }).from_(category_totals).where(CategoryRating.id == category_totals.c.id).execute()
+    character_totals = (GlobalRating
+                        .select(GlobalRating.id, fn.COUNT(CategoryRelationship.id).alias('vote_count'),
+                                fn.COALESCE(fn.SUM(CategoryRelationship.score), 0).alias('score_sum'))
+                        .join(CategoryRelationship, JOIN.LEFT_OUTER,
+                              on=(CategoryRelationship.character == GlobalRating.character))
+                        .group_by(GlobalRating.id))
+    GlobalRating.update({
+        GlobalRating.vote_count: character_totals.c.vote_count,
+        GlobalRating.score_sum: character_totals.c.score_sum
+    }).from_(character_totals).where(GlobalRating.id == character_totals.c.id).execute()
+
+
+def advance_ratings_job(time_budget=RATINGS_JOB_TIME_BUDGET):
+    # Every step is committed together with the checkpoint, so a request that gets killed only loses the step it was
+    # on. Returns whether the job is done, if not then the next call continues where this one stopped.
+    deadline = time.monotonic() + time_budget
+    while True:
+        with DATABASE.transaction():
+            if not DATABASE.execute_sql('SELECT pg_try_advisory_xact_lock(%s)',
+                                        (WORKER_RATINGS_JOB_LOCK,)).fetchone()[0]:
+                # The ratings job with the worker processes is running, it does everything this one would do.
+                return False
+            done = _run_ratings_job_step()
+        if done:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+
+
+def update_all_ratings():
+    # Recomputes everything from scratch (the vote totals too), every step is still a single set-based statement though.
+    with DATABASE.transaction():
+        _claim_rating_changes()
+        recount_vote_totals()
+        _update(changes=None)
+        refresh_leaderboards()
+
+
+def run_ratings_job(processes: int, everything=False):
+    # Same thing as the ratings job of the cron job, but the universes are split across a pool of worker processes,
+    # which is a lot faster when there are many universes to go through. Nothing is shown before the global ranks are
+    # done and everything gets published at once.
+    # The worker processes are forked, so they must not inherit any connection from this process. That's why they're
+    # started before anything is connected.
+    DATABASE.close_all()
+    with Pool(processes) as pool, DATABASE.connection_context():
+        # Held on this connection until the very end, so no cron job request publishes half staged ranks meanwhile.
+        DATABASE.execute_sql('SELECT pg_advisory_lock(%s)', (WORKER_RATINGS_JOB_LOCK,))
+        try:
+            _run_ratings_job_in_pool(pool, processes, everything)
+        finally:
+            DATABASE.execute_sql('SELECT pg_advisory_unlock(%s)', (WORKER_RATINGS_JOB_LOCK,))
+
+
+def _run_ratings_job_in_pool(pool, processes: int, everything: bool):
+    with DATABASE.transaction():
+        job_in_progress = _lock_ratings_job().phase is not None
+    if job_in_progress:
+        # The cron job requests stopped in the middle of a ratings job, it's finished first instead of thrown away.
+        advance_ratings_job(time_budget=float('inf'))
+    with DATABASE.transaction():
+        changes = _claim_rating_changes()
+        if everything:
+            recount_vote_totals()
+            changes = RatingChanges(changes.rows + [(universe.id, None, None) for universe in
+                                                    Universe.select(Universe.id)])
+    if not changes:
+        return
+    try:
+        pool.map(_update_universes_in_worker, changes.split_by_universe(processes))
+        with DATABASE.transaction():
+            _update_globals(changes)
+            _publish()
+            refresh_leaderboards()
+    except Exception:
+        # Putting the claimed changes back, so the next run does them again.
+        _requeue_rating_changes(changes)
+        raise
+
+
+def _update_universes_in_worker(rows):
+    with DATABASE.connection_context():
+        with DATABASE.transaction():
+            _update_universes(RatingChanges(rows))
+
+
+def _update(changes):
+    _update_universes(changes)
+    _update_globals(changes)
+    _publish()
+
+
+def _update_universes(changes):
+    # Everything in here only touches the universes of the changes.
+    _update_category_scores(changes)
+    _update_overall_scores(changes)
+    _update_universe_ranks(changes)
+
+
+def _update_globals(changes):
+    _update_global_category_ranks(changes)
+    _update_global_ranks()
+
+
+def _run_ratings_job_step():
+    job = _lock_ratings_job()
+    if job.phase is None:
+        # Starting a new job with every change that came in since the last one, the ones coming in while it runs are
+        # for the next job.
+        if not RatingChange.update({RatingChange.claimed: True}).where(~RatingChange.claimed).execute():
+            return True
+        job.phase, job.universe_cursor = RATINGS_JOB_PHASES[0], 0
+    elif job.phase in ('category_scores', 'overall_scores', 'universe_ranks'):
+        universes = [change.universe_id for change in RatingChange
+                     .select(RatingChange.universe_id).distinct()
+                     .where((RatingChange.claimed) & (RatingChange.universe_id > job.universe_cursor))
+                     .order_by(RatingChange.universe_id)
+                     .limit(UNIVERSES_PER_STEP)]
+        if universes:
+            changes = _claimed_rating_changes(universes)
+            if job.phase == 'category_scores':
+                _update_category_scores(changes)
+            elif job.phase == 'overall_scores':
+                _update_overall_scores(changes)
+            else:
+                _update_universe_ranks(changes)
+            job.universe_cursor = universes[-1]
+        else:
+            job.phase, job.universe_cursor = _next_phase(job.phase), 0
+    elif job.phase == 'global_ranks':
+        _update_globals(_claimed_rating_changes())
+        job.phase = _next_phase(job.phase)
+    elif job.phase == 'publish':
+        _publish()
+        RatingChange.delete().where(RatingChange.claimed).execute()
+        job.phase = _next_phase(job.phase)
+    else:
+        refresh_leaderboards()
+        job.phase = None
+    job.save()
+    return job.phase is None
+
+
+def refresh_leaderboards():
+    # Concurrently, so the leaderboard pages can still be read while they are refreshed.
+    for leaderboard in (OverallLeaderboard, CategoryLeaderboard):
+        DATABASE.execute_sql(f'REFRESH MATERIALIZED VIEW CONCURRENTLY "{leaderboard._meta.table_name}"')
+
+
+def _next_phase(phase):
+    return RATINGS_JOB_PHASES[RATINGS_JOB_PHASES.index(phase) + 1]
+
+
+def _lock_ratings_job():
+    # Locking the checkpoint, so two cron job requests never work on the ratings job at the same time.
+    RatingsJob.insert(id=1).on_conflict_ignore().execute()
+    return RatingsJob.select().where(RatingsJob.id == 1).for_update().get()
+
+
+def _claim_rating_changes():
+    # Takes every change, also the ones of a ratings job that is still running, since everything they need is done
+    # right away anyway (run_ratings_job finishes that job first though, update_all_ratings redoes everything).
+    # Deleting and returning in one statement, so a vote that comes in meanwhile is never lost.
+    job = _lock_ratings_job()
+    job.phase = None
+    job.save()
+    claimed = RatingChange.delete().returning(RatingChange.universe_id, RatingChange.character_id,
+                                              RatingChange.category_id).execute()
+    return RatingChanges([(row.universe_id, row.character_id, row.category_id) for row in claimed])
+
+
+def _claimed_rating_changes(universes=None):
+    query = (RatingChange
+             .select(RatingChange.universe_id, RatingChange.character_id, RatingChange.category_id)
+             .where(RatingChange.claimed))
+    if universes is not None:
+        query = query.where(RatingChange.universe_id.in_(universes))
+    return RatingChanges(list(query.tuples()))
+
+
+def _requeue_rating_changes(changes):
+    RatingChange.insert_many([row + (False,) for row in changes.rows],
+                             fields=[RatingChange.universe_id, RatingChange.character_id, RatingChange.category_id,
+                                     RatingChange.claimed]).execute()
+
+
+def _score_or_none(rating):
+    # The scores are stored with 3 decimals, formatting them is done when they are shown.
+    return Case(None, [(rating.vote_count >= NUMBER_OF_REQUIRED_PEOPLE,
+                        fn.ROUND(rating.score_sum.cast('numeric') / rating.vote_count, 3))])
+
+
+def _rank_or_none(score, rank):
+    # If the score is none then the rank has to be none too.
+    return Case(None, [(score.is_null(), None)], rank)
+
+
+def _by_score(score):
+    return [-score, +Character.id]
+
+
+def _characters_in(universes):
+    return Character.select(Character.id).where(Character.universe.in_(list(universes)))
+
+
+def _update_category_scores(changes):
+    # The scores are just a division of the vote totals now, the votes themselves aren't read at all.
+    score = _score_or_none(CategoryRating)
+    query = CategoryRating.update({
+        CategoryRating.next_category_score: score,
+        CategoryRating.next_global_category_rank: _rank_or_none(score, CategoryRating.next_global_category_rank),
+        CategoryRating.next_universe_category_rank: _rank_or_none(score, CategoryRating.next_universe_category_rank)
+    })
+    if changes is not None:
+        query = query.where((Tuple(CategoryRating.character, CategoryRating.category).in_(list(changes.pairs))) |
+                            (CategoryRating.character.in_(_characters_in(changes.whole_universes))))
+    query.execute()
+
+
+def _update_overall_scores(changes):
+    score = _score_or_none(GlobalRating)
+    query = GlobalRating.update({
+        GlobalRating.next_overall_score: score,
+        GlobalRating.next_global_rank: _rank_or_none(score, GlobalRating.next_global_rank),
+        GlobalRating.next_universe_rank: _rank_or_none(score, GlobalRating.next_universe_rank)
+    })
+    if changes is not None:
+        query = query.where((GlobalRating.character.in_(list(changes.characters))) |
+                            (GlobalRating.character.in_(_characters_in(changes.whole_universes))))
+    query.execute()
+
+
+def _update_universe_ranks(changes):
+    _update_universe_category_ranks(changes)
+    _update_universe_overall_ranks(changes)
+
+
+def _update_universe_category_ranks(changes):
+    # Every category belongs to exactly one universe, so partitioning by the category ranks every universe at once.
+    ranks = (CategoryRating
+             .select(CategoryRating.id, fn.ROW_NUMBER().over(
+                 partition_by=[CategoryRating.category],
+                 order_by=_by_score(CategoryRating.next_category_score)).alias('rank'))
+             .join(Character)
+             .switch(CategoryRating)
+             .join(Category, on=(Category.id == CategoryRating.category) & (Category.universe == Character.universe))
+             .where(CategoryRating.next_category_score.is_null(False)))
+    if changes is not None:
+        # Filtering by the partition only, so the categories that get ranked are always ranked as a whole.
+        ranks = ranks.where((CategoryRating.category.in_(list(changes.categories))) |
+                            (Category.universe.in_(list(changes.whole_universes))))
+    CategoryRating.update({
+        CategoryRating.next_universe_category_rank: ranks.c.rank
+    }).from_(ranks).where(CategoryRating.id == ranks.c.id).execute()
+
+
+def _update_universe_overall_ranks(changes):
+    ranks = (GlobalRating
+             .select(GlobalRating.id, fn.ROW_NUMBER().over(
+                 partition_by=[Character.universe],
+                 order_by=_by_score(GlobalRating.next_overall_score)).alias('rank'))
+             .join(Character)
+             .where((Character.universe.is_null(False)) & (GlobalRating.next_overall_score.is_null(False))))
+    if changes is not None:
+        ranks = ranks.where(Character.universe.in_(list(changes.universes)))
+    GlobalRating.update({
+        GlobalRating.next_universe_rank: ranks.c.rank
+    }).from_(ranks).where(GlobalRating.id == ranks.c.id).execute()
+
+
+def _update_global_category_ranks(changes):
+    # Categories with the same name across universes are ranked together, but only for the global category names.
+    ranks = (CategoryRating
+             .select(CategoryRating.id, fn.ROW_NUMBER().over(
+                 partition_by=[Category.name],
+                 order_by=_by_score(CategoryRating.next_category_score)).alias('rank'))
+             .join(Character)
+             .switch(CategoryRating)
+             .join(Category)
+             .where((Character.official) & (CategoryRating.next_category_score.is_null(False)) &
+                    (Category.name.in_(CATEGORY_NAMES))))
+    # A whole universe changing (like a deleted character) can move every global category, otherwise only the global
+    # categories that got votes have to be ranked again.
+    if changes is not None and not changes.whole_universes:
+        changed_names = Category.select(Category.name).where(Category.id.in_(list(changes.categories)))
+        ranks = ranks.where(Category.name.in_(changed_names))
+    CategoryRating.update({
+        CategoryRating.next_global_category_rank: ranks.c.rank
+    }).from_(ranks).where(CategoryRating.id == ranks.c.id).execute()
+
+
+def _update_global_ranks():
+    ranks = (GlobalRating
+             .select(GlobalRating.id, fn.ROW_NUMBER().over(
+                 order_by=_by_score(GlobalRating.next_overall_score)).alias('rank'))
+             .join(Character)
+             .where((Character.official) & (GlobalRating.next_overall_score.is_null(False))))
+    GlobalRating.update({
+        GlobalRating.next_global_rank: ranks.c.rank
+    }).from_(ranks).where(GlobalRating.id == ranks.c.id).execute()
+
+
+def _publish():
+    # Copies every score and rank that got updated over to the ones people see, all at once.
+    staged, published = ((GlobalRating.next_overall_score, GlobalRating.next_global_rank,
+                          GlobalRating.next_universe_rank),
+                         (GlobalRating.overall_score, GlobalRating.global_rank, GlobalRating.universe_rank))
+    GlobalRating.update(dict(zip(published, staged))).where(_is_distinct_from(published, staged)).execute()
+    staged, published = ((CategoryRating.next_category_score, CategoryRating.next_global_category_rank,
+                          CategoryRating.next_universe_category_rank),
+                         (CategoryRating.category_score, CategoryRating.global_category_rank,
+                          CategoryRating.universe_category_rank))
+    CategoryRating.update(dict(zip(published, staged))).where(_is_distinct_from(published, staged)).execute()
+
+
+def _is_distinct_from(columns, other_columns):
+    # Unlike "!=" this also works when one of them is null.
+    return Expression(Tuple(*columns), 'IS DISTINCT FROM', Tuple(*other_columns))
@@ -1,14 +1,21 @@
+import os
 import re
-from statistics import mean
-from string import ascii_uppercase as alphabet
 
+import click
 from flask import Blueprint, g, redirect, url_for, render_template, request, flash, jsonify, abort, make_response
 from flask_login import login_required
 from playhouse.flask_utils import get_object_or_404
 
 from characters.forms import CharacterForm, CharacterPictureForm, CategoryForm
-from characters.utils import _build_comment_tree, _extract_comment_data, render_all_or_specific_characters, generate_score_in_proper_format, live_search_character_suggestions, live_search_universe_suggestions, \
-    search_universe_names, search_characters_and_their_ratings, UNIVERSE_ALL_SEARCH_AMOUNT, UNIVERSE_ONLY_SEARCH_AMOUNT, CHARACTER_ALL_SEARCH_AMOUNT, CHARACTER_ONLY_SEARCH_AMOUNT, CATEGORY_NAMES, filter_characters, extract_proper_character_data
+from characters.live_search import LIVE_SEARCH_INDEX
+from characters.search_cache import SEARCH_CACHE
+from characters.search_executor import SEARCH_EXECUTOR
+from characters.universe_directory import UNIVERSE_DIRECTORY, NOT_ALPHABETICAL
+from characters.ratings import advance_ratings_job, update_all_ratings, run_ratings_job, mark_rating_changed, \
+    change_vote_totals
+from characters.utils import _build_comment_tree, _extract_comments_data, render_all_or_specific_characters, generate_score_in_proper_format, live_search_character_suggestions, live_search_universe_suggestions, \
+    search_universe_names, search_characters_and_their_ratings, UNIVERSE_ALL_SEARCH_AMOUNT, UNIVERSE_ONLY_SEARCH_AMOUNT, CHARACTER_ALL_SEARCH_AMOUNT, CHARACTER_ONLY_SEARCH_AMOUNT, CATEGORY_NAMES, filter_characters, extract_proper_character_data, \
+    search_result_rows, SEARCH_MODES, load_comment_users, forget_comment_users
 from mails import send_ping_user_email
 from main import limiter, app
 from models import DATABASE, Character, CharacterTemp, upload_image, Comment, CommentRelationship, User, Ping, \
@@ -17,6 +24,15 @@ from models import DATABASE, Character, CharacterTemp, upload_image, Comment, Co
 from utils import create_pic_hashid, resize_image, decode_char_hashid, _return_proper_datetime, image_size_reducer
 
 characters = Blueprint('characters', __name__)
+# The scores are formatted in the templates of the other blueprints too.
+characters.add_app_template_global(generate_score_in_proper_format)
+
+
+@characters.before_app_first_request
+def build_live_search_index():
+    # The autocomplete is answered from memory, so the index is built before the first request.
+    with DATABASE.connection_context():
+        LIVE_SEARCH_INDEX.rebuild()
 
 
 @characters.route('/search', methods=('GET',))
@@ -26,37 +42,42 @@ def search():
         # Setup variables.
         filter_search = False
         search_category_toggle = request.cookies.get('search_category_toggle', 'all')
+        search_mode = request.cookies.get('search_mode', 'contains')
+        if search_mode not in SEARCH_MODES:
+            search_mode = 'contains'
         # Check if the length of the query exceeds 100 characters, if it does, then flash an error message.
         if len(query) > 100:
             flash(message="We don't accept searches longer than 100 letters/characters", category="warning")
             return render_template("search_suggestions.html", search_query_input=request.args, errors=True, search_category_toggle=search_category_toggle, 
-                filter_search=filter_search)
+                search_mode=search_mode, filter_search=filter_search)
         else:
             errors = False  # There are no errors if we reached this else scope.
             query = query.strip()  # Strip the query so it takes less processing power when searching for it, I know it's only going to make a small difference.
             more_data = {}
             if search_category_toggle == 'universes':
                 characters = None
-                universe_names, more_universes = search_universe_names(query, limit=UNIVERSE_ONLY_SEARCH_AMOUNT)
+                universe_names, more_universes = search_universe_names(query, limit=UNIVERSE_ONLY_SEARCH_AMOUNT, mode=search_mode)
                 more_data.update(universes=more_universes)
             elif search_category_toggle == 'characters':
                 universe_names = None
-                characters, more_characters = search_characters_and_their_ratings(query, limit=CHARACTER_ONLY_SEARCH_AMOUNT)
+                characters, more_characters = search_characters_and_their_ratings(query, limit=CHARACTER_ONLY_SEARCH_AMOUNT, mode=search_mode)
                 more_data.update(characters=more_characters)
-            elif search_category_toggle == 'all':
-                universe_names, more_universes = search_universe_names(query)
-                characters, more_characters = search_characters_and_their_ratings(query)
-                more_data.update(characters=more_characters, universes=more_universes)
             else:
                 search_category_toggle = 'all'
-                universe_names, more_universes = search_universe_names(query)
-                characters, more_characters = search_characters_and_their_ratings(query)
+                # The two searches don't depend on each other, so they're run at the same time.
+                results = SEARCH_EXECUTOR.run(universes=lambda: search_universe_names(query, mode=search_mode),
+                                              characters=lambda: search_characters_and_their_ratings(query, mode=search_mode))
+                if None in results.values():
+                    flash(message="Some of the search results couldn't be loaded in time, so they're missing. Please try again", category="warning")
+                universe_names, more_universes = results['universes'] or (None, False)
+                characters, more_characters = results['characters'] or ((), False)
                 more_data.update(characters=more_characters, universes=more_universes)
     else:
         # Setup variables.
         filter_search = True
         universe_names = None
         search_category_toggle = 'character filter'
+        search_mode = None
 
         # Dict of the predefined query parameters that are required for the search view (dict that simulates the expected "request.args" dict object).
         # I had to make it here so there will always be created a new dict every request, if i didn't do that, an instance would share same dict and that would cause great confusion for the user.
@@ -85,10 +106,12 @@ def search():
         if not data:
             return render_template("search_suggestions_errors.html", error_message="Whitespace/no data, is not acceptable", category="Warning", search_category_toggle=search_category_toggle)
         
-        characters = filter_characters(data).order_by(+Character.id).limit(CHARACTER_ONLY_SEARCH_AMOUNT)  # Reason why I'm ordering by id is that if a character gets a new global_rank then it could mess up the pagination!
-        more_data = {'characters': bool(characters.offset(CHARACTER_ONLY_SEARCH_AMOUNT).limit(1).count())}
+        # One extra character is fetched to know if there are more characters to retrieve.
+        characters = tuple(search_result_rows(filter_characters(data)).order_by(+Character.id).limit(CHARACTER_ONLY_SEARCH_AMOUNT + 1))  # Reason why I'm ordering by id is that if a character gets a new global_rank then it could mess up the pagination!
+        more_data = {'characters': len(characters) > CHARACTER_ONLY_SEARCH_AMOUNT}
+        characters = characters[:CHARACTER_ONLY_SEARCH_AMOUNT]
     return render_template('search_suggestions.html', search_query_input=request.args, characters=characters, universe_name_rows=universe_names,
-        filter_search=filter_search, search_category_toggle=search_category_toggle, errors=errors, more_data=more_data)
+        filter_search=filter_search, search_category_toggle=search_category_toggle, search_mode=search_mode, errors=errors, more_data=more_data)
 
 
 @characters.route('/character_filter_search', methods=('GET',))
@@ -111,9 +134,8 @@ def ajax_character_filter_search():
         page = 1
     # Set the current character load offset by the given current page.
     offset = page * CHARACTER_ONLY_SEARCH_AMOUNT
-    characters = filter_characters(data).order_by(+Character.id).offset(offset).limit(CHARACTER_ONLY_SEARCH_AMOUNT)  # Reason why I'm ordering by id is that if a character gets a new global_rank then it could mess up the pagination!
-    more_characters = bool(characters.offset(offset + CHARACTER_ONLY_SEARCH_AMOUNT).limit(1).count())
-    return jsonify(characters=extract_proper_character_data(characters), more_data=more_characters)
+    characters = list(search_result_rows(filter_characters(data)).order_by(+Character.id).offset(offset).limit(CHARACTER_ONLY_SEARCH_AMOUNT + 1))  # Reason why I'm ordering by id is that if a character gets a new global_rank then it could mess up the pagination!
+    return jsonify(characters=extract_proper_character_data(characters[:CHARACTER_ONLY_SEARCH_AMOUNT]), more_data=len(characters) > CHARACTER_ONLY_SEARCH_AMOUNT)
 
 
 @characters.route('/character_search', methods=('GET',))
@@ -126,11 +148,15 @@ def ajax_character_search():
         return jsonify(message="Missing query parameter!"), 422
     # Gotta have the search_category_toggle cookie value sent as a query argument since the user can change the cookie value at anytime.
     limit = CHARACTER_ONLY_SEARCH_AMOUNT if request.args.get('search_category_toggle', type=str) == "characters" else CHARACTER_ALL_SEARCH_AMOUNT
+    # Same goes for the search mode cookie value.
+    search_mode = request.args.get('search_mode', default='contains', type=str)
+    if search_mode not in SEARCH_MODES:
+        search_mode = 'contains'
     page = request.args.get('page', default=1, type=int)
     # Make sure that the page is not 0 so users don't abuse this route for retrieving characters instead of using the "search" route
     if page < 1:
         page = 1
-    characters, more_characters = search_characters_and_their_ratings(query, offset=page * limit, limit=limit)
+    characters, more_characters = search_characters_and_their_ratings(query, offset=page * limit, limit=limit, mode=search_mode)
     return jsonify(characters=extract_proper_character_data(characters), more_data=more_characters)
 
 
@@ -144,20 +170,22 @@ def ajax_universe_search():
         return jsonify(message="Missing query parameter!"), 422
     # Gotta have the search_category_toggle cookie value sent as a query argument since the user can change the cookie value at anytime.
     limit = UNIVERSE_ONLY_SEARCH_AMOUNT if request.args.get('search_category_toggle', type=str) == "universes" else UNIVERSE_ALL_SEARCH_AMOUNT
+    # Same goes for the search mode cookie value.
+    search_mode = request.args.get('search_mode', default='contains', type=str)
+    if search_mode not in SEARCH_MODES:
+        search_mode = 'contains'
     page = request.args.get('page', default=1, type=int)
     # Make sure that the page is not 0 so users don't abuse this route for retrieving characters instead of using the "search" route
     if page < 1:
         page = 1
-    universe_names, more_universes = search_universe_names(query, offset=page * limit, limit=limit)
+    universe_names, more_universes = search_universe_names(query, offset=page * limit, limit=limit, mode=search_mode)
     return jsonify(universes=universe_names, more_data=more_universes)
 
 
 @characters.route('/live_search', methods=('POST',))
 def live_search():
     query = request.form.get('query', type=str, default='').strip()
-    if query and not len(query) > 100:        
-        query = re.sub(r'[^\w+]', '+', query.strip().replace(' ', '+')) + ':*'
-    else:
+    if not query or len(query) > 100:
         return jsonify(suggestions=[])
     search_category_toggle = request.cookies.get('search_category_toggle', 'all')
     if search_category_toggle == 'all':
@@ -208,54 +236,22 @@ def render_universe_characters(universe_name: str):
 
 @characters.route('/universes', methods=('GET',))
 def render_universes():
-    uni_alp_dict = {}  # default dicts are now ordered in python 3.7 yay, don't have to sort it or use orderedDict!
-    uni_not_alp_list = []
-    row_index_alp = 0
-    col_index_alp = 0
-    row_index_not_alp = 0
-    col_index_not_alp = 0
-    universe_names = [universe[1] for universe in Universe.select().order_by(Universe.name).tuples()]
-    for name in universe_names:
-        no_match = True
-        for letter in list(alphabet):
-            if re.match(fr'^{letter}', name.upper()):
-                arr = uni_alp_dict.get(letter)
-                if arr:
-                    # checks to see if there are exactly 20 universe names inside a given column array.
-                    if len(arr[row_index_alp][col_index_alp]) == 20:
-                        # checks to see if there are exactly 4 columns inside a given row.
-                        if col_index_alp == 3:
-                            arr.append([[name]])
-                            row_index_alp += 1
-                            col_index_alp = 0
-                        else:
-                            arr[row_index_alp].append([name])
-                            col_index_alp += 1
-                    else:
-                        arr[row_index_alp][col_index_alp].append(name)
-                else:
-                    uni_alp_dict[letter] = [[[]]]
-                    row_index_alp = 0
-                    col_index_alp = 0
-                    uni_alp_dict[letter][row_index_alp][col_index_alp].append(name)
-                no_match = False
-                break
-        if no_match:
-            if not len(uni_not_alp_list):
-                uni_not_alp_list.append([[]])
-            # checks to see if there are exactly 20 universe names inside a given column array.
-            if len(uni_not_alp_list[row_index_not_alp][col_index_not_alp]) == 20:
-                # checks to see if there are exactly 4 columns inside a given row.
-                if col_index_not_alp == 3:
-                    uni_not_alp_list.append([[name]])
-                    row_index_not_alp += 1
-                    col_index_not_alp = 0
-                else:
-                    uni_not_alp_list[row_index_not_alp].append([name])
-                    col_index_not_alp += 1
-            else:
-                uni_not_alp_list[row_index_not_alp][col_index_not_alp].append(name)
-    return render_template('universes.html', universes_alp=uni_alp_dict, universes_not_alp=uni_not_alp_list)
+    letters = UNIVERSE_DIRECTORY.letters()
+    # Only the first tab is sent with the page, the other letters are fetched when they're opened.
+    alphabetical = [letter for letter in letters if letter != NOT_ALPHABETICAL]
+    active_letter = alphabetical[0] if alphabetical else (letters[0] if letters else None)
+    return render_template('universes.html', letters=letters, active_letter=active_letter,
+                           universes=UNIVERSE_DIRECTORY.rows(active_letter) if active_letter else [],
+                           not_alphabetical=NOT_ALPHABETICAL)
+
+
+@characters.route('/universe_directory/<letter>', methods=('GET',))
+def universe_directory(letter: str):
+    rows = UNIVERSE_DIRECTORY.rows(letter)
+    if not rows:
+        return jsonify(message="There are no universes starting with that letter"), 404
+    return jsonify([[[{'name': name, 'link': url_for('characters.render_universe_characters', universe_name=name)}
+                      for name in column] for column in row] for row in rows])
 
 
 @characters.route('/characters/<hashid>/pictures', methods=('GET',))
@@ -338,77 +334,40 @@ def add_character():
 def cron_job_update_ratings():
     if app.config['CRON_JOB_SECURE'] and not request.headers.get('X-Appengine-Cron'):
         abort(403)
-    # Here you can change the amount of people required to rate before actually calculating a score for a character.
-    number_of_required_people = 1  # must not be zero as that doesn't make sense.
-
-    # Normally i would've ordered it like this: "-CategoryRating.category_score". But now I'm ordering it like this:
-    # "-fn.to_number(CategoryRating.category_score, '999G999')" why? Because if the category score is
-    # precisely 100,000 then it would normally rank that as the lowest, pretty weird, right!
-    for universe in Universe.select():
-        for character_instance in universe.characters.tuples():
-            # update the category_scores for every character
-            for category in universe.categories.tuples():
-                scores = [score[4] for score in CategoryRelationship.select().where((CategoryRelationship.category == category[0]) & (CategoryRelationship.character == character_instance[0])).tuples()]
-                if len(scores) >= number_of_required_people:
-                    score = generate_score_in_proper_format(mean(scores))
-                else:
-                    score = None
-                    # If the category_score is none then set the global_category_rank and the universe_category_rank to none too.
-                    CategoryRating.update({
-                        CategoryRating.global_category_rank: score,
-                        CategoryRating.universe_category_rank: score
-                    }).where((CategoryRating.category == category[0]) & (CategoryRating.character == character_instance[0])).execute()
-                CategoryRating.update({
-                    CategoryRating.category_score: score
-                }).where((CategoryRating.category == category[0]) & (CategoryRating.character == character_instance[0])).execute()
-
-            # update the overall_score for every character
-            scores = [score[4] for score in CategoryRelationship.select().where(CategoryRelationship.character == character_instance[0]).tuples()]
-            if len(scores) >= number_of_required_people:
-                score = generate_score_in_proper_format(mean(scores))
-            else:
-                score = None
-                # If the overall_score is none then set the global_rank and the universe_rank to none too.
-                GlobalRating.update({
-                    GlobalRating.global_rank: score,
-                    GlobalRating.universe_rank: score
-                }).where(GlobalRating.character == character_instance[0]).execute()
-            GlobalRating.update({
-                GlobalRating.overall_score: score
-            }).where(GlobalRating.character == character_instance[0]).execute()
-
-        # update the universe_category_ranks for every character
-        for category in universe.categories.tuples():
-            for i, character_instance in enumerate(universe.characters.join(CategoryRating).where((CategoryRating.category == category[0]) & (CategoryRating.category_score.is_null(False))).order_by(-fn.to_number(CategoryRating.category_score, '999G999')).tuples()):
-                CategoryRating.update({
-                    CategoryRating.universe_category_rank: i + 1
-                }).where((CategoryRating.category == category[0]) & (CategoryRating.character == character_instance[0])).execute()
-
-        # update the universe_rank for every character
-        for i, character_instance in enumerate(universe.characters.join(GlobalRating).where(GlobalRating.overall_score.is_null(False)).order_by(-fn.to_number(GlobalRating.overall_score, '999G999')).tuples()):
-            GlobalRating.update({
-                GlobalRating.universe_rank: i + 1
-            }).where(GlobalRating.character == character_instance[0]).execute()
-
-    # update the global_category_ranks for every character
-    for category_name in CATEGORY_NAMES:
-        categories = [category[0] for category in Category.select().where(Category.name == category_name).tuples()]
-        for i, character_instance in enumerate(Character.select().join(CategoryRating).where((Character.official) & (CategoryRating.category_score.is_null(False)) & (CategoryRating.category.in_(categories))).order_by(-fn.to_number(CategoryRating.category_score, '999G999')).tuples()):
-            CategoryRating.update({
-                CategoryRating.global_category_rank: i + 1
-            }).where((CategoryRating.category.in_(categories)) & (CategoryRating.character == character_instance[0])).execute()
-
-    # update the global_rank for every character
-    for i, character_instance in enumerate(Character.select().join(GlobalRating).where((Character.official) & (GlobalRating.overall_score.is_null(False))).order_by(-fn.to_number(GlobalRating.overall_score, '999G999')).tuples()):
-        GlobalRating.update({
-            GlobalRating.global_rank: i + 1
-        }).where(GlobalRating.character == character_instance[0]).execute()
-
-    response = make_response('It was a success!')
+    # The ratings job is split into steps, so when the time is up the next cron job request continues from there.
+    done = advance_ratings_job()
+    # The ranks and scores in the cached search results might have changed in any of the steps.
+    SEARCH_CACHE.clear()
+    if done:
+        response = make_response('It was a success!')
+    else:
+        response = make_response('Not done yet, the next run continues where this one stopped.')
     response.mimetype = 'text/plain'
     return response
 
 
+@characters.cli.command('update_all_ratings')
+def update_all_ratings_command():
+    """Recomputes every score and rank from scratch, not just the ones that got votes."""
+    update_all_ratings()
+
+
+@characters.cli.command('run_ratings_job')
+@click.option('--processes', type=click.IntRange(min=1), default=os.cpu_count(), show_default=True,
+              help='How many worker processes to use.')
+@click.option('--all', 'everything', is_flag=True, help='Recompute everything, not just the ones that got votes.')
+def run_ratings_job_command(processes, everything):
+    """Updates the ratings with a pool of worker processes, without the deadline of the cron job request."""
+    run_ratings_job(processes, everything)
+
+
+@characters.cli.command('recount_comment_likes')
+def recount_comment_likes_command():
+    """Counts the likes of every comment again from scratch, in case the like counts got out of sync."""
+    with DATABASE.atomic():
+        Comment.recount_like_counts()
+
+
 @characters.route('/characters/<hashid>/rate', methods=('POST',))
 @limiter.limit('15/minute')
 def rate(hashid):
@@ -434,20 +393,27 @@ def rate(hashid):
     category = Category.get_or_none((Category.name == category_name) & (Category.universe == single_character.universe))
     if not category:
         return jsonify(message="The specified category doesn't exist"), 422
-    if CategoryRelationship.select().where(
-            (CategoryRelationship.category == category) & (CategoryRelationship.character == single_character) & (
-                    CategoryRelationship.user == g.user.id)).exists():
-        CategoryRelationship.update({
-            CategoryRelationship.score: score
-        }).where((CategoryRelationship.category == category) & (CategoryRelationship.character == single_character) & (
-                CategoryRelationship.user == g.user.id)).execute()
-    else:
-        CategoryRelationship.create_category_relationship(
-            category=category,
-            character=single_character,
-            user=g.user.id,
-            score=score
-        )
+    with DATABASE.transaction():
+        # Locking the old vote, so the difference added to the vote totals is always the right one.
+        old_vote = CategoryRelationship.select().where(
+                (CategoryRelationship.category == category) & (CategoryRelationship.character == single_character) & (
+                        CategoryRelationship.user == g.user.id)).for_update().first()
+        if old_vote:
+            CategoryRelationship.update({
+                CategoryRelationship.score: score
+            }).where(CategoryRelationship.id == old_vote.id).execute()
+            change_vote_totals(single_character, category, vote_count_difference=0,
+                               score_difference=score - old_vote.score)
+        else:
+            CategoryRelationship.create_category_relationship(
+                category=category,
+                character=single_character,
+                user=g.user.id,
+                score=score
+            )
+            change_vote_totals(single_character, category, vote_count_difference=1, score_difference=score)
+        # Let the cron job know that the ratings of this character in this category needs to be recomputed.
+        mark_rating_changed(single_character, category)
     return jsonify(data)
 
 
@@ -473,7 +439,15 @@ def delete_rate(hashid):
     if not score:
         return jsonify(status='success', message="The score didn't exist in the first place in fact")
     else:
-        score.delete_instance()
+        with DATABASE.transaction():
+            # Only the one that actually deleted the vote gets to subtract it from the totals, and the score comes
+            # from the deleted row itself in case it got changed in the meantime.
+            deleted_votes = list(CategoryRelationship.delete().where(CategoryRelationship.id == score.id)
+                                 .returning(CategoryRelationship.score).execute())
+            if deleted_votes:
+                change_vote_totals(single_character, category, vote_count_difference=-1,
+                                   score_difference=-deleted_votes[0].score)
+                mark_rating_changed(single_character, category)
         return jsonify(status='success')
 
 
@@ -503,8 +477,8 @@ def rating(hashid):
                     'global_category_rank': category_rating.global_category_rank,
                     'universe_rank': global_rating.universe_rank,
                     'universe_category_rank': category_rating.universe_category_rank,
-                    'overall_score': global_rating.overall_score,
-                    'category_score': category_rating.category_score})
+                    'overall_score': generate_score_in_proper_format(global_rating.overall_score),
+                    'category_score': generate_score_in_proper_format(category_rating.category_score)})
 
 
 @characters.route('/characters/<hashid>/add_picture', methods=('POST',))
@@ -538,8 +512,6 @@ def comments(hashid):
     single_character = Character.get_or_none(Character.id == character_id)
     if not single_character:
         return jsonify(message="The character you're trying to retrieve comments from doesn't exist"), 404
-    if not single_character.comments.exists():
-        return jsonify([[], {'more_comments': False}, {'last_comment_id': None, 'next_comment_id': None}])
     newest_comment_id = request.args.get('newest_comment_id', type=int)
     if not newest_comment_id:
         return jsonify([[], {'more_comments': False}, {'last_comment_id': None, 'next_comment_id': None}])
@@ -549,15 +521,17 @@ def comments(hashid):
     elif per_page < 1:
         per_page = 1
     next_comment_id = request.args.get('next_comment_id', default=newest_comment_id, type=int)
-    comment_ids = single_character.comments.where(Comment.parent.is_null()).order_by(-Comment.id).where(
-        Comment.id <= next_comment_id).select(Comment.id).limit(per_page)
-    if not comment_ids.exists():
+    # One extra head comment is fetched, it's where the next page starts if there is one.
+    comment_ids = [comment_id for comment_id, in single_character.comments.select(Comment.id).where(
+        Comment.parent.is_null() & (Comment.id <= next_comment_id)).order_by(-Comment.id).limit(per_page + 1).tuples()]
+    if not comment_ids:
         return jsonify([[], {'more_comments': False}, {'last_comment_id': None, 'next_comment_id': None}])
-    comment_tree = _build_comment_tree(comment_ids, single_character.comments)
-    comments_array = [_extract_comment_data(comment) for comment in comment_tree]
-    last_comment_id = list(comment_ids).pop().id
-    next_comment_id = list(comment_ids.limit(per_page + 1)).pop().id
-    more_comments = last_comment_id != next_comment_id
+    comment_tree = _build_comment_tree(comment_ids[:per_page])
+    comments_array = _extract_comments_data(comment_tree)
+    # Without a next page the next comment id is the same as the last one, that's what the front-end expects.
+    last_comment_id = comment_ids[:per_page][-1]
+    next_comment_id = comment_ids[-1]
+    more_comments = len(comment_ids) > per_page
     return jsonify([comments_array, {'more_comments': more_comments},
                     {'last_comment_id': last_comment_id, 'next_comment_id': next_comment_id}])
 
@@ -570,30 +544,20 @@ def comment_users(hashid):
     single_character = Character.get_or_none(Character.id == character_id)
     if not single_character:
         return jsonify(message="The character you're trying to retrieve users from doesn't exist"), 404
-    if not single_character.comments.where(Comment.user != g.user.id).exists():
-        return jsonify([])
     last_comment_id = request.args.get('last_comment_id', type=int)
     newest_comment_id = request.args.get('newest_comment_id', type=int)
     if not (last_comment_id and newest_comment_id):
         return jsonify(
             message="You're fast, trying to ping users when no comments have been loaded yet, wait a bit please"), 422
-    comment_ids = single_character.comments.where(Comment.parent.is_null()).order_by(-Comment.id).where(
-        Comment.id.between(last_comment_id, newest_comment_id)).select(Comment.id)
-    if not comment_ids.exists():
+    users = load_comment_users(single_character.id, last_comment_id, newest_comment_id)
+    # Nobody to ping if it's only the current user.
+    if all(user_id == g.user.id for user_id, username, profile_picture in users):
         return jsonify([])
-    comment_tree = _build_comment_tree(comment_ids, single_character.comments)
-    users_array, unique_user_ids, unique_comments = [], [], []
-    for comment in comment_tree:
-        if comment.user.id not in unique_user_ids:
-            unique_user_ids.append(comment.user.id)
-            unique_comments.append(comment)
-    for comment in unique_comments:
-        users_array.append({
-            'id': comment.user.id,
-            'fullname': 'Current User' if g.user.id == comment.user.id else comment.user.username,
-            'profile_picture_url': comment.user.profile_picture
-        })
-    return jsonify(users_array)
+    return jsonify([{
+        'id': user_id,
+        'fullname': 'Current User' if g.user.id == user_id else username,
+        'profile_picture_url': profile_picture
+    } for user_id, username, profile_picture in users])
 
 
 @characters.route('/characters/<hashid>/add_comment', methods=('POST',))
@@ -627,6 +591,7 @@ def add_comment(hashid):
         content=content,
         created=_return_proper_datetime(data["created"])
     )
+    forget_comment_users(single_character.id)
     comment_content = comment.content
     for user in users_to_be_pinged:
         Ping.create_ping(comment=comment, user=user)
@@ -634,7 +599,7 @@ def add_comment(hashid):
     for user in users_to_be_pinged:
         if user.email_confirmed and user.receive_email_pings and not user.is_banned:
             send_ping_user_email(user.email, user.username, comment, comment_content)
-    return jsonify(_extract_comment_data(comment))
+    return jsonify(_extract_comments_data([comment])[0])
 
 
 @characters.route('/comments/<int:comment_id>/update', methods=('PUT',))
@@ -678,7 +643,7 @@ def update_comment(comment_id):
             Ping.create_ping(comment=comment, user=user)
             if user.email_confirmed and user.receive_email_pings and not user.is_banned:
                 send_ping_user_email(user.email, user.username, comment, comment_content)
-    return jsonify(_extract_comment_data(comment))
+    return jsonify(_extract_comments_data([comment])[0])
 
 
 @characters.route('/comments/<int:comment_id>/upvote', methods=('POST',))
@@ -707,12 +672,10 @@ def downvote_comment(comment_id):
         return jsonify(message='Your email is not confirmed, please confirm it'), 401
     if not Comment.select().where(Comment.id == comment_id).exists():
         return jsonify(message="The comment you're trying to unlike doesn't exist anymore"), 404
-    like = CommentRelationship.get_or_none(CommentRelationship.from_user == g.user.id,
-                                           CommentRelationship.to_comment == comment_id)
-    if not like:
+    if not CommentRelationship.delete_comment_relationships((CommentRelationship.from_user == g.user.id) &
+                                                            (CommentRelationship.to_comment == comment_id)):
         return jsonify(message="Please don't spam the like button, please wait a bit before using the button again"), \
                409
-    like.delete_instance()
     return jsonify(status="success")
 
 
@@ -728,6 +691,7 @@ def delete_comment(comment_id):
         return jsonify(stauts="success", message="The comment didn't exist in the first place in fact")
     if g.user.is_admin or comment.user.id == g.user.id:
         comment.delete_instance()
+        forget_comment_users(comment.character_id)
         return jsonify(status="success")
     else:
         return jsonify(message='You do not own the comment, therefore you cannot delete the comment'), 401
@@ -0,0 +1,87 @@
+import inspect
+from functools import wraps
+from threading import Lock
+
+from cachetools import TTLCache
+
+# A few popular names make up most of the searches, so their results are kept for a while. The admin routes and the
+# ratings cron job empty the cache when they change characters, universes or ranks, but every instance of the website
+# has its own cache, so the others only notice when the results are older than this (in seconds).
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_SIZE = 1024
+
+
+class _CountingTTLCache(TTLCache):
+    # The least recently used results are thrown out when the cache is full, those are counted.
+
+    def __init__(self, maxsize, ttl, on_eviction):
+        super().__init__(maxsize, ttl)
+        self._on_eviction = on_eviction
+
+    def popitem(self):
+        item = super().popitem()
+        self._on_eviction()
+        return item
+
+
+class SearchCache:
+    """Keeps the results of the searches by (what is searched for, the query, offset and limit), with a TTL and LRU
+    eviction. Counts the hits, misses and evictions, which the admins can see at /admin/search_cache."""
+
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = Lock()
+        self._cache = _CountingTTLCache(maxsize, ttl, self._count_eviction)
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def cached(self, kind: str):
+        """Caches a search function that takes the query first. The query is normalized before it's searched for, the
+        searches are case insensitive anyway."""
+
+        def decorator(function):
+            signature = inspect.signature(function)
+
+            @wraps(function)
+            def wrapper(query: str, *args, **kwargs):
+                arguments = signature.bind(normalize_query(query), *args, **kwargs)
+                arguments.apply_defaults()
+                key = (kind, *arguments.arguments.values())
+                with self._lock:
+                    try:
+                        result = self._cache[key]
+                        self.hits += 1
+                        return result
+                    except KeyError:
+                        self.misses += 1
+                result = function(*arguments.args, **arguments.kwargs)
+                with self._lock:
+                    self._cache[key] = result
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def clear(self):
+        # A new cache instead of clear(), which would count every result as an eviction.
+        with self._lock:
+            self._cache = _CountingTTLCache(self.maxsize, self.ttl, self._count_eviction)
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'hit_rate': self.hits / lookups if lookups else None,
+                    'size': len(self._cache), 'maxsize': self.maxsize, 'ttl': self.ttl}
+
+    def _count_eviction(self):
+        self.evictions += 1
+
+
+def normalize_query(query: str):
+    return query.strip().lower()
+
+
+SEARCH_CACHE = SearchCache()
@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+
+from flask import current_app
+from psycopg2.extensions import QueryCanceledError
+
+from config import MAX_CONNECTIONS
+from models import DATABASE, OperationalError
+
+# The searches of the "all" toggle don't depend on each other, so they're run at the same time, each one on its own
+# connection from the pool. Postgres cancels a search that takes longer than this (in milliseconds), so a slow universe
+# search can't hold back the characters, the page is just shown without the results of that search.
+SEARCH_STATEMENT_TIMEOUT = 2000
+# The workers take their connections from the same pool as the requests, so they never get more than half of it.
+SEARCH_WORKERS = max(1, min(8, MAX_CONNECTIONS // 2))
+
+
+class SearchExecutor:
+    def __init__(self, workers=SEARCH_WORKERS, statement_timeout=SEARCH_STATEMENT_TIMEOUT):
+        self.statement_timeout = statement_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='search')
+
+    def run(self, **searches):
+        """Runs every search (a function without arguments) at the same time and returns their results by the same
+        names. The result of a search that timed out or failed is None, so the page can still be shown without it."""
+        futures = {name: self._executor.submit(self._run, search) for name, search in searches.items()}
+        # Waiting for a free worker isn't covered by the statement timeout, so the searches get a bit
+        # longer than it in total before they're given up on.
+        wait(futures.values(), timeout=self.statement_timeout / 1000 * 2)
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=0)
+            except TimeoutError:
+                results[name] = None
+            except Exception as error:
+                # E.g. no free connection in the pool (MaxConnectionsExceeded), that's no reason to fail the whole page.
+                current_app.logger.error(f'The {name} search failed', exc_info=error)
+                results[name] = None
+        return results
+
+    def _run(self, search):
+        try:
+            with DATABASE.connection_context(), DATABASE.atomic():
+                # "SET LOCAL" only lasts until the end of the transaction, the connection goes back to the pool after.
+                DATABASE.execute_sql(f'SET LOCAL statement_timeout = {int(self.statement_timeout)}')
+                return search()
+        except (QueryCanceledError, OperationalError) as error:
+            # Postgres cancelled it (peewee doesn't always wrap that error), every other error is raised like normal.
+            if isinstance(error, QueryCanceledError) or isinstance(error.__context__, QueryCanceledError):
+                raise TimeoutError from error
+            raise
+
+
+SEARCH_EXECUTOR = SearchExecutor()
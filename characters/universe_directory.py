@@ -0,0 +1,64 @@
+import time
+from string import ascii_uppercase as alphabet
+from threading import Lock
+
+from models import Universe
+
+# The /universes page lists the universes by their first letter, which only changes when a universe is created, renamed
+# or deleted. The admin routes throw the directory away when that happens, but there can be more than one instance of
+# the website running, so it's also built again when it's older than this (in seconds).
+UNIVERSE_DIRECTORY_TTL = 600
+# Every letter is shown in rows of 4 columns, with 20 universe names in each column.
+UNIVERSE_DIRECTORY_COLUMNS = 4
+UNIVERSE_DIRECTORY_COLUMN_LENGTH = 20
+# The universes that don't start with a letter are put under "#", which can't be used in a url.
+NOT_ALPHABETICAL = 'hash'
+
+
+class UniverseDirectory:
+    """The names of all the universes grouped by their first letter and laid out in rows and columns, so the page
+    doesn't have to do it on every request."""
+
+    def __init__(self, ttl=UNIVERSE_DIRECTORY_TTL):
+        self.ttl = ttl
+        self._letters = None
+        self._built_at = None
+        self._lock = Lock()
+
+    def letters(self):
+        # Ordered like the tabs of the page, the universes that don't start with a letter first.
+        return list(self._directory())
+
+    def rows(self, letter: str):
+        return self._directory().get(letter, [])
+
+    def invalidate(self):
+        with self._lock:
+            self._letters = None
+
+    def _directory(self):
+        with self._lock:
+            if self._letters is None or time.monotonic() - self._built_at > self.ttl:
+                self._letters = _group_by_first_letter(
+                    name for name, in Universe.select(Universe.name).order_by(Universe.name).tuples())
+                self._built_at = time.monotonic()
+            return self._letters
+
+
+def _group_by_first_letter(universe_names):
+    names_of_letter = {}
+    for name in universe_names:
+        letter = name.upper()[:1]
+        names_of_letter.setdefault(letter if letter in alphabet else NOT_ALPHABETICAL, []).append(name)
+    letters = sorted(names_of_letter, key=lambda letter: (letter != NOT_ALPHABETICAL, letter))
+    return {letter: _lay_out(names_of_letter[letter]) for letter in letters}
+
+
+def _lay_out(names):
+    columns = [names[index:index + UNIVERSE_DIRECTORY_COLUMN_LENGTH]
+               for index in range(0, len(names), UNIVERSE_DIRECTORY_COLUMN_LENGTH)]
+    return [columns[index:index + UNIVERSE_DIRECTORY_COLUMNS]
+            for index in range(0, len(columns), UNIVERSE_DIRECTORY_COLUMNS)]
+
+
+UNIVERSE_DIRECTORY = UniverseDirectory()
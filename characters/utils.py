@@ -1,12 +1,18 @@
 import re
+from collections import Counter
 from decimal import Decimal, ROUND_HALF_UP
+from threading import Lock
 
+from cachetools import TTLCache, LRUCache, cached
 from flask import g, request, render_template, abort, url_for
 from flask_paginate import Pagination
-from playhouse.shortcuts import model_to_dict
 
+from characters.live_search import LIVE_SEARCH_INDEX
+from characters.search_cache import SEARCH_CACHE
 from main import app
-from models import Comment, CommentRelationship, Character, DataError, CategoryRating, GlobalRating, Category, Universe
+from models import Comment, CommentRelationship, Ping, User, Character, DataError, GlobalRating, Category, Universe, \
+    OverallLeaderboard, CategoryLeaderboard, Tuple, JOIN, fn, SEARCH_CONFIGURATION
+from numeric_attributes import parse_numeric_attribute, parse_numeric_range
 from utils import create_char_hashid
 
 # When removing some global category remember to delete ALL the global_category_rank data in the database associated
@@ -25,6 +31,33 @@ CHARACTER_ONLY_SEARCH_AMOUNT = 20
 # Amount of characters to load if the cookie has been set to all search.
 CHARACTER_ALL_SEARCH_AMOUNT = 10
 
+# How the search bar matches the names, the user picks one in the filter search modal and it's kept in a cookie.
+# "contains" finds the query anywhere in a name, "full_text" finds the names with every word of the query and shows the
+# best matches first.
+SEARCH_MODES = ('contains', 'full_text')
+
+# The leaderboards have numbered page links up to this page, after that you can only go to the next or previous page,
+# since those pages are found by the rank and id of the last/first character shown instead of skipping all the rows before.
+LEADERBOARD_NUMBERED_PAGES = 10
+
+# How long (in seconds) the total amount of characters of a leaderboard is remembered. The leaderboards only change when
+# the ratings job runs (every 10 minutes) anyway.
+LEADERBOARD_TOTAL_TTL = 600
+
+_leaderboard_totals = TTLCache(maxsize=4096, ttl=LEADERBOARD_TOTAL_TTL)
+
+# The users that can be pinged in the comments of a character are remembered by character and by the range of head
+# comments loaded on the page. They're forgotten when comments are added to or deleted from the character, but every
+# instance of the website has its own, and new usernames and profile pictures don't forget them either, so they're only
+# kept for this long (in seconds).
+COMMENT_USERS_TTL = 300
+
+_comment_users = TTLCache(maxsize=1024, ttl=COMMENT_USERS_TTL)
+_comment_users_lock = Lock()
+# How many times the users of a character were forgotten, under None how many times all of them were. Users loaded
+# while they were forgotten could be from before the change, so they're not stored.
+_comment_users_generations = Counter()
+
 
 def render_all_or_specific_characters(form, category_name, universe=None):
     page = request.args.get('page', default=1, type=int)
@@ -33,52 +66,126 @@ def render_all_or_specific_characters(form, category_name, universe=None):
         per_page = 50
     elif per_page < 1:
         per_page = 1
-    # Making "category_ratings" and "global_ratings" into tuples is faster in terms of computing power!
+    # The leaderboards are materialized views refreshed by the ratings job, every one of them matches an index so a page
+    # is just a single range scan. Every row is a character together with its rank and score, so the template never has
+    # to line up the characters with their ratings.
     if universe:
         if category_name:
             category = Category.get((Category.universe == universe) & (Category.name == category_name))
-            characters_to_paginate = Character.select().join(CategoryRating).where(CategoryRating.category == category).order_by(+CategoryRating.universe_category_rank)
-            category_ratings = CategoryRating.select().where(CategoryRating.category == category).order_by(+CategoryRating.universe_category_rank)
-            ranks_and_scores = [(rating[4], rating[5]) for rating in category_ratings.paginate(page=page, paginate_by=per_page).tuples()]
+            rank = CategoryLeaderboard.universe_category_rank
+            characters_to_paginate = CategoryLeaderboard.select().where(CategoryLeaderboard.category_id == category.id)
         else:
-            characters_to_paginate = Character.select().where(Character.universe == universe).join(GlobalRating).order_by(+GlobalRating.universe_rank)
-            global_ratings = GlobalRating.select().where(GlobalRating.character.in_(characters_to_paginate)).order_by(+GlobalRating.universe_rank)
-            ranks_and_scores = [(rating[3], rating[4]) for rating in global_ratings.paginate(page=page, paginate_by=per_page).tuples()]
+            rank = OverallLeaderboard.universe_rank
+            characters_to_paginate = OverallLeaderboard.select().where(OverallLeaderboard.universe_id == universe.id)
     else:
         if category_name:
-            categories = [category for category in Category.select().where(Category.name == category_name)]
-            characters_to_paginate = Character.select().join(CategoryRating).where((Character.official) & (CategoryRating.category.in_(categories))).order_by(+CategoryRating.global_category_rank)
-            category_ratings = CategoryRating.select().join(Character).where((CategoryRating.category.in_(categories)) & (Character.official)).order_by(+CategoryRating.global_category_rank)
-            ranks_and_scores = [(rating[3], rating[5]) for rating in category_ratings.paginate(page=page, paginate_by=per_page).tuples()]
+            rank = CategoryLeaderboard.global_category_rank
+            characters_to_paginate = CategoryLeaderboard.select().where((CategoryLeaderboard.official) & (CategoryLeaderboard.category_name == category_name))
+        else:
+            rank = OverallLeaderboard.global_rank
+            characters_to_paginate = OverallLeaderboard.select().where(OverallLeaderboard.official)
+    model = characters_to_paginate.model
+    character_id = model.id
+    characters_to_paginate = characters_to_paginate.select(character_id, model.name, model.character_picture, model.occupation,
+                                                           model.official, rank.alias('rank'), model.score)
+    total = _leaderboard_total(characters_to_paginate, (rank.name, universe.id if universe else None, category_name))
+    after, before = request.args.get('after'), request.args.get('before')
+    if after or before:
+        # Keyset pagination, the characters right after (or right before) the given character in the order of the
+        # leaderboard. Characters without a rank come last, but NULLs don't work with the row comparison and an OR would
+        # stop it from being used on the index, so the ranked and the unranked characters are fetched separately.
+        cursor_rank, cursor_id = _parse_leaderboard_cursor(after or before)
+        if after:
+            parts = [] if cursor_rank is None else [(Tuple(rank, character_id) > Tuple(cursor_rank, cursor_id), (+rank, +character_id))]
+            parts.append((rank.is_null() & (character_id > cursor_id) if cursor_rank is None else rank.is_null(), (+character_id,)))
         else:
-            characters_to_paginate = Character.select().where(Character.official).join(GlobalRating).order_by(+GlobalRating.global_rank)
-            global_ratings = GlobalRating.select().where(GlobalRating.character.in_(characters_to_paginate)).order_by(+GlobalRating.global_rank)
-            ranks_and_scores = [(rating[2], rating[4]) for rating in global_ratings.paginate(page=page, paginate_by=per_page).tuples()]
-    total = characters_to_paginate.count()
-    pagination_characters = characters_to_paginate.paginate(page=page, paginate_by=per_page)
-    pagination = Pagination(page=page, per_page=per_page, total=total, css_framework='bootstrap4', bs_version=4,
-                            record_name='characters', format_number=True, format_total=True, alignment='center',
-                            display_msg="Displaying <b>{start} - {end}</b> {record_name} in a total of <b>{total}</b>")
+            parts = [(rank.is_null() & (character_id < cursor_id), (-character_id,))] if cursor_rank is None else []
+            parts.append((rank.is_null(False) if cursor_rank is None else Tuple(rank, character_id) < Tuple(cursor_rank, cursor_id), (-rank, -character_id)))
+        pagination_characters = []
+        for condition, ordering in parts:
+            if len(pagination_characters) < per_page:
+                pagination_characters.extend(characters_to_paginate.where(condition).order_by(*ordering).limit(per_page - len(pagination_characters)))
+        if before:
+            pagination_characters.reverse()
+    else:
+        pagination_characters = list(characters_to_paginate.order_by(+rank, +character_id).paginate(page=page, paginate_by=per_page))
+    numbered_pages = not (after or before)
+
+    # Past the numbered pages you go on with the rank and id of the last character, and back with the first one.
+    next_url = previous_url = None
+    if pagination_characters and page * per_page < total and (page >= LEADERBOARD_NUMBERED_PAGES or not numbered_pages):
+        next_url = _leaderboard_url(category_name, page + 1, after=_leaderboard_cursor(pagination_characters[-1]))
+    if not numbered_pages and page > 1:
+        if page - 1 <= LEADERBOARD_NUMBERED_PAGES:
+            previous_url = _leaderboard_url(category_name, page - 1)
+        elif pagination_characters:
+            previous_url = _leaderboard_url(category_name, page - 1, before=_leaderboard_cursor(pagination_characters[0]))
+
+    # The page links only go as far as the numbered pages, the real total is still shown in the message.
+    pagination = Pagination(page=page, per_page=per_page, total=min(total, LEADERBOARD_NUMBERED_PAGES * per_page) if numbered_pages else total,
+                            css_framework='bootstrap4', bs_version=4, record_name='characters', format_number=True, alignment='center',
+                            display_msg="Displaying <b>{start} - {end}</b> {record_name} in a total of <b>%s</b>" % '{0:,}'.format(total))
 
     try:
-        return render_template('characters.html', characters=pagination_characters, pagination=pagination, form=form,
-                               category=category_name if category_name else '', universe=universe.name if universe else None, ratings=ranks_and_scores)
+        return render_template('characters.html', characters=tuple(pagination_characters), pagination=pagination, form=form,
+                               category=category_name if category_name else '', universe=universe.name if universe else None,
+                               numbered_pages=numbered_pages, next_url=next_url, previous_url=previous_url)
     except DataError:
         abort(404)
 
 
-def search_characters_and_their_ratings(query: str, offset=0, limit=CHARACTER_ALL_SEARCH_AMOUNT):
-    characters = Character.select().where(Character.name.contains(query)).order_by(+Character.id).offset(offset).limit(limit)  # Reason why I'm ordering by id is that if a character gets a new global_rank then it could mess up the pagination!
+@cached(_leaderboard_totals, key=lambda query, key: key, lock=Lock())
+def _leaderboard_total(query, key):
+    return query.count()
+
+
+def _leaderboard_cursor(character):
+    return f"{'none' if character.rank is None else character.rank}-{character.id}"
+
+
+def _parse_leaderboard_cursor(cursor: str):
+    try:
+        rank_value, character_id = cursor.split('-')
+        return None if rank_value == 'none' else int(rank_value), int(character_id)
+    except ValueError:
+        abort(404)
+
+
+def _leaderboard_url(category_name, page, **cursor):
+    # Keeps the universe name of the url, url_for leaves the category out when it's None.
+    return url_for(request.endpoint, **request.view_args, category=category_name or None, page=page, **cursor)
+
+
+# The "contains" searches are "ILIKE '%query%'", which the trigram indexes (look in migrations.py) can be used for, the
+# names most similar to the query come first. The "full_text" searches use the GIN indexes of the search names instead,
+# and the best ranked matches come first. One extra row is fetched to know if there are more to retrieve. The results
+# are cached, look in characters/search_cache.py.
+
+@SEARCH_CACHE.cached('characters')
+def search_characters_and_their_ratings(query: str, offset=0, limit=CHARACTER_ALL_SEARCH_AMOUNT, mode='contains'):
+    characters = search_result_rows(Character.select())
+    if mode == 'full_text':
+        # The most popular characters come first when they match equally well.
+        characters = characters.where(Character.search_name.match(query, SEARCH_CONFIGURATION, plain=True)).order_by(fn.ts_rank(Character.search_name, fn.plainto_tsquery(SEARCH_CONFIGURATION, query)).desc(), GlobalRating.global_rank.asc(nulls='LAST'), +Character.id)
+    else:
+        characters = characters.where(Character.name.contains(query)).order_by(fn.similarity(Character.name, query).desc(), +Character.id)
+    characters = tuple(characters.offset(offset).limit(limit + 1))  # Reason why I'm also ordering by id is that characters with the same name could otherwise swap places between the pages!
     # Return the characters, and then a boolean value indicating if there are more characters to retrieve.
-    return characters, bool(Character.select().where(Character.name.contains(query)).offset(offset + limit).limit(1).count())
+    return characters[:limit], len(characters) > limit
 
 
-def search_universe_names(query: str, offset=0, limit=UNIVERSE_ALL_SEARCH_AMOUNT):
+@SEARCH_CACHE.cached('universes')
+def search_universe_names(query: str, offset=0, limit=UNIVERSE_ALL_SEARCH_AMOUNT, mode='contains'):
     row_index = 0
     col_index = 0
-    universes = Universe.select().where(Universe.name.contains(query)).offset(offset).limit(limit)
-    universe_rows = [[[]]] if universes.exists() else None
-    for universe_name in [universe[1] for universe in universes.tuples()]:
+    universes = Universe.select(Universe.name)
+    if mode == 'full_text':
+        universes = universes.where(Universe.search_name.match(query, SEARCH_CONFIGURATION, plain=True)).order_by(fn.ts_rank(Universe.search_name, fn.plainto_tsquery(SEARCH_CONFIGURATION, query)).desc(), +Universe.id)
+    else:
+        universes = universes.where(Universe.name.contains(query)).order_by(fn.similarity(Universe.name, query).desc(), +Universe.id)
+    universe_names = [universe[0] for universe in universes.offset(offset).limit(limit + 1).tuples()]
+    universe_rows = [[[]]] if universe_names else None
+    for universe_name in universe_names[:limit]:
         # Checks to see if there are 20 universe names inside a given column
         if len(universe_rows[row_index][col_index]) == 20:
             # Checks to see if there are 4 columns inside a row
@@ -92,15 +199,17 @@ def search_universe_names(query: str, offset=0, limit=UNIVERSE_ALL_SEARCH_AMOUNT
         else:
             universe_rows[row_index][col_index].append(universe_name)
     # Return the universe rows and also a boolean value indicating if there are more universes to retrieve.
-    return universe_rows, bool(Universe.select().where(Universe.name.contains(query)).offset(offset + limit).limit(1).count())
+    return universe_rows, len(universe_names) > limit
 
 
+# The autocomplete is answered from memory, look in characters/live_search.py.
+
 def live_search_character_suggestions(query, limit):
-    return [{"value": character_instance[2], "data": {"category": 'Characters', 'source': character_instance[5], 'link': url_for('characters.character', hashid=create_char_hashid(character_instance[0], app.config['CHARACTER'])), 'official': character_instance[14], 'ratings': model_to_dict(GlobalRating.get(GlobalRating.character == character_instance[0]), exclude=[GlobalRating.id, GlobalRating.character, GlobalRating.universe_rank])}} for character_instance in Character.select().where(Character.search_name.match(query)).limit(limit).tuples()]
+    return [{"value": character.name, "data": {"category": 'Characters', 'source': character.picture, 'link': url_for('characters.character', hashid=create_char_hashid(character.id, app.config['CHARACTER'])), 'official': character.official, 'ratings': {'global_rank': character.global_rank, 'overall_score': generate_score_in_proper_format(character.overall_score)}}} for character in LIVE_SEARCH_INDEX.search_characters(query, limit)]
 
 
 def live_search_universe_suggestions(query, limit):
-    return [{'value': universe[1], 'data': {'category': 'Universes', 'link': url_for('characters.render_universe_characters', universe_name=universe[1])}} for universe in Universe.select().where(Universe.search_name.match(query)).limit(limit).tuples()]
+    return [{'value': universe.name, 'data': {'category': 'Universes', 'link': url_for('characters.render_universe_characters', universe_name=universe.name)}} for universe in LIVE_SEARCH_INDEX.search_universes(query, limit)]
 
 
 def filter_characters(data: dict):
@@ -110,12 +219,8 @@ def filter_characters(data: dict):
             characters = characters.where(Character.name.contains(v))
         elif k == 'universe':
             characters = characters.join(Universe).where(Universe.name.contains(v))
-        elif k == 'age':
-            characters = characters.where(Character.age == v)
-        elif k == 'height':
-            characters = characters.where(Character.height == v)
-        elif k == 'weight':
-            characters = characters.where(Character.weight == v)
+        elif k in ('age', 'height', 'weight'):
+            characters = characters.where(_numeric_attribute_condition(k, v))
         elif k == 'species':
             characters = characters.where(Character.species.contains(v))
         elif k == 'gender':
@@ -129,42 +234,135 @@ def filter_characters(data: dict):
     return characters
 
 
+def _numeric_attribute_condition(name, user_input):
+    # A range like "150-180" matches every known number in it, otherwise it has to be the same as what was typed in, so
+    # "100" doesn't match "100+".
+    number, open_ended, unknown, infinite = (getattr(Character, f'{name}_{column}') for column in
+                                             ('number', 'open_ended', 'unknown', 'infinite'))
+    numeric_range = parse_numeric_range(user_input)
+    if numeric_range:
+        return ~unknown & ~infinite & number.between(*numeric_range)
+    parsed = parse_numeric_attribute(user_input)
+    if parsed is None:
+        # It can't match anything that has been parsed, but this is what the search always did.
+        return getattr(Character, name) == user_input
+    if parsed['unknown']:
+        return unknown
+    if parsed['infinite']:
+        return ~unknown & infinite
+    return ~unknown & ~infinite & (number == parsed['number']) & (open_ended == parsed['open_ended'])
+
+
+def search_result_rows(characters):
+    # Only what the search results show, with the global rank and overall score joined in, so nothing has to be looked up
+    # one character at a time. Every row is a dict.
+    return (characters.select(Character.id, Character.name, Character.character_picture, Character.occupation, Character.official,
+                              GlobalRating.global_rank, GlobalRating.overall_score)
+            .switch(Character).join(GlobalRating, JOIN.LEFT_OUTER).dicts())
+
+
 def extract_proper_character_data(characters):
-    return [{'url': url_for('characters.character', hashid=create_char_hashid(character.id, extra_salt=app.config['CHARACTER'])), 'name': character.name, 
-    'picture': character.character_picture, 'official': character.official, 'occupation': character.occupation, 'global_rank': character.global_rating.get().global_rank, 
-    'overall_score': character.global_rating.get().overall_score} for character in characters]
+    return [{'url': url_for('characters.character', hashid=create_char_hashid(character['id'], extra_salt=app.config['CHARACTER'])), 'name': character['name'], 
+    'picture': character['character_picture'], 'official': character['official'], 'occupation': character['occupation'], 'global_rank': character['global_rank'], 
+    'overall_score': generate_score_in_proper_format(character['overall_score'])} for character in characters]
 
 
-def _extract_comment_data(comment: Comment):
-    return {
+def _extract_comments_data(comments):
+    # The users, pings and likes of all the comments are loaded together, so it's the same few queries for any amount
+    # of comments. The like counts are stored on the comments themselves.
+    comment_ids = [comment.id for comment in comments]
+    if not comment_ids:
+        return []
+    users = {user.id: user for user in User.select(User.id, User.username, User.profile_picture, User.is_admin).where(
+        User.id << {comment.user_id for comment in comments})}
+    pings_of_comment = {}
+    for comment_id, user_id, username in (Ping.select(Ping.from_comment, User.id, User.username).join(User)
+                                          .where(Ping.from_comment << comment_ids).order_by(Ping.id).tuples()):
+        pings_of_comment.setdefault(comment_id, {})[user_id] = username
+    upvoted_comment_ids = {comment_id for comment_id, in CommentRelationship.select(CommentRelationship.to_comment).where(
+        (CommentRelationship.to_comment << comment_ids) & (CommentRelationship.from_user == g.user.id)).tuples()
+    } if g.user.is_authenticated else set()
+    return [{
         'id': comment.id,
-        'created_by_current_user': g.user.is_authenticated and g.user.id == comment.user.id,
-        'created_by_admin': comment.user.is_admin,
-        'pings': {ping.to_user.id: ping.to_user.username for ping in comment.pings},
+        'created_by_current_user': g.user.is_authenticated and g.user.id == comment.user_id,
+        'created_by_admin': users[comment.user_id].is_admin,
+        'pings': pings_of_comment.get(comment.id, {}),
         'content': comment.content,
-        'parent': comment.parent.id if comment.parent else None,
+        'parent': comment.parent_id,
         'modified': comment.modified.isoformat(),
         'created': comment.created.isoformat(),
-        'fullname': comment.user.username,
-        'user_has_upvoted': g.user.is_authenticated and comment.likes.where(
-            CommentRelationship.from_user == g.user.id).select().exists(),
-        'creator': comment.user.id,
-        'profile_picture_url': comment.user.profile_picture,
-        'upvote_count': comment.likes.count()
-    }
-
-
-def _build_comment_tree(head_comment_ids, all_comments):
-    comments = Comment.select().where(Comment.id << head_comment_ids)
-    for comment in all_comments.where(Comment.parent << head_comment_ids):
-        if all_comments.where(Comment.parent << [comment.id]).exists():
-            comments += _build_comment_tree([comment.id], all_comments)
+        'fullname': users[comment.user_id].username,
+        'user_has_upvoted': g.user.is_authenticated and comment.id in upvoted_comment_ids,
+        'creator': comment.user_id,
+        'profile_picture_url': users[comment.user_id].profile_picture,
+        'upvote_count': comment.like_count
+    } for comment in comments]
+
+
+def _comment_tree(head_comments):
+    # The ids of the head comments, their replies, the replies to those and so on, as a recursive common table expression.
+    head_comments = head_comments.select(Comment.id).cte('comment_tree', recursive=True)
+    Reply = Comment.alias()
+    replies = Reply.select(Reply.id).join(head_comments, on=(Reply.parent == head_comments.c.id))
+    return head_comments.union_all(replies)
+
+
+def _build_comment_tree(head_comment_ids):
+    # The head comments and all of their replies are fetched in one query.
+    comment_tree = _comment_tree(Comment.select().where(Comment.id << head_comment_ids))
+    comments = list(Comment.select().join(comment_tree, on=(Comment.id == comment_tree.c.id)).with_cte(comment_tree)
+                    .order_by(Comment.id))
+    # Then every head comment is followed by its replies, the newest head comments first and the oldest replies first.
+    comment_ids = {comment.id for comment in comments}
+    replies_of_comment = {}
+    for comment in comments:
+        if comment.parent_id in comment_ids:
+            replies_of_comment.setdefault(comment.parent_id, []).append(comment)
+    ordered_comments, stack = [], [comment for comment in comments if comment.parent_id not in comment_ids]
+    while stack:
+        comment = stack.pop()
+        ordered_comments.append(comment)
+        stack.extend(reversed(replies_of_comment.get(comment.id, [])))
+    return ordered_comments
+
+
+def load_comment_users(character_id: int, last_comment_id: int, newest_comment_id: int):
+    # Every user that wrote one of the head comments between the two ids or a reply to them, only once.
+    key = (last_comment_id, newest_comment_id)
+    with _comment_users_lock:
+        users_of_range = _comment_users.get(character_id)
+        if users_of_range is not None and key in users_of_range:
+            return users_of_range[key]
+        generation = _comment_users_generations[None], _comment_users_generations[character_id]
+    comment_tree = _comment_tree(Comment.select().where(
+        (Comment.character == character_id) & Comment.parent.is_null() &
+        Comment.id.between(last_comment_id, newest_comment_id)))
+    users = list(User.select(User.id, User.username, User.profile_picture).distinct()
+                 .join(Comment, on=(Comment.user == User.id))
+                 .join(comment_tree, on=(Comment.id == comment_tree.c.id))
+                 .with_cte(comment_tree).order_by(User.id).tuples())
+    with _comment_users_lock:
+        if generation == (_comment_users_generations[None], _comment_users_generations[character_id]):
+            # A character can have a lot of ranges, only the most recently used ones are kept.
+            _comment_users.setdefault(character_id, LRUCache(maxsize=64))[key] = users
+    return users
+
+
+def forget_comment_users(character_id=None):
+    # Without a character the users of every character are forgotten.
+    with _comment_users_lock:
+        _comment_users_generations[character_id] += 1
+        if character_id is None:
+            _comment_users.clear()
         else:
-            comments += Comment.select().where(Comment.id == comment.id)
-    return comments
+            _comment_users.pop(character_id, None)
 
 
-def generate_score_in_proper_format(score: float):
+# The scores are stored as numbers with 3 decimals, this is only used when they are about to be shown to the user,
+# e.g. 93.417 becomes "93,417" and 0.5 becomes "500".
+def generate_score_in_proper_format(score):
+    if score is None:
+        return None
     score = Decimal(score)
     string_value = str(score.quantize(Decimal('0.001'), ROUND_HALF_UP))
     string_value = string_value.replace('.', ',')
@@ -1,7 +1,8 @@
 from main import app
 from models import DATABASE, CharacterTemp, User, Character, Comment, CommentRelationship, Ping, \
     CharacterTempPicture, CharacterPicture, Universe, Category, CategoryRelationship, CategoryTemp, GlobalRating, \
-    CategoryRating
+    CategoryRating, RatingChange, RatingsJob
+from migrations import run_migrations
 
 DEBUG = True
 PORT = 8080
@@ -10,8 +11,10 @@ HOST = 'localhost'
 DATABASE.connect()
 DATABASE.create_tables(
     [User, CharacterTemp, Character, Comment, CommentRelationship, Ping, CharacterTempPicture, CharacterPicture,
-     Universe, Category, CategoryRelationship, CategoryTemp, GlobalRating, CategoryRating],
+     Universe, Category, CategoryRelationship, CategoryTemp, GlobalRating, CategoryRating, RatingChange,
+     RatingsJob],
     safe=True)
+run_migrations()
 DATABASE.close()
 
 app.run(debug=DEBUG, port=PORT, host=HOST)
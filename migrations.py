@@ -0,0 +1,183 @@
+from peewee import ValuesList
+from playhouse.migrate import PostgresqlMigrator, migrate
+
+# The app has to be set up first, the models and the blueprints import each other through it.
+import main
+from characters.ratings import recount_vote_totals
+from models import DATABASE, RatingChange, RatingsJob, GlobalRating, CategoryRating, Character, Category, Universe, \
+    OverallLeaderboard, CategoryLeaderboard, Comment, SEARCH_CONFIGURATION
+
+
+# Run this file to bring an existing database up to date with the models, like this: "python migrations.py".
+# Every migration must be safe to run more than once, since all of them are run every single time.
+
+
+def create_rating_change_table():
+    DATABASE.create_tables([RatingChange], safe=True)
+
+
+def convert_scores_to_numbers():
+    # The scores used to be stored as formatted strings like "93,417" (93.417) and "500" (0.5), so removing the comma
+    # and dividing by 1000 gives the real score back.
+    for table, column in (('Global_rating', 'overall_score'), ('Category_rating', 'category_score')):
+        data_types = {column_metadata.name: column_metadata.data_type for column_metadata in DATABASE.get_columns(table)}
+        if data_types[column] == 'character varying':
+            DATABASE.execute_sql(f"""ALTER TABLE "{table}" ALTER COLUMN "{column}" TYPE numeric(6, 3)
+                                     USING replace("{column}", ',', '')::numeric / 1000""")
+
+
+def create_rating_indexes():
+    GlobalRating._schema.create_indexes(safe=True)
+    CategoryRating._schema.create_indexes(safe=True)
+
+
+def add_vote_totals():
+    added = _add_missing_columns(GlobalRating, [GlobalRating.vote_count, GlobalRating.score_sum])
+    added = _add_missing_columns(CategoryRating, [CategoryRating.vote_count, CategoryRating.score_sum]) or added
+    # The totals start at zero, so they have to be counted from the votes that already exist.
+    if added:
+        recount_vote_totals()
+
+
+def add_ratings_job():
+    DATABASE.create_tables([RatingsJob], safe=True)
+    _add_missing_columns(RatingChange, [RatingChange.claimed])
+    # The staged scores and ranks have to start out the same as the ones people see.
+    if _add_missing_columns(GlobalRating, [GlobalRating.next_global_rank, GlobalRating.next_universe_rank,
+                                           GlobalRating.next_overall_score]):
+        GlobalRating.update({
+            GlobalRating.next_global_rank: GlobalRating.global_rank,
+            GlobalRating.next_universe_rank: GlobalRating.universe_rank,
+            GlobalRating.next_overall_score: GlobalRating.overall_score
+        }).execute()
+    if _add_missing_columns(CategoryRating, [CategoryRating.next_global_category_rank,
+                                             CategoryRating.next_universe_category_rank,
+                                             CategoryRating.next_category_score]):
+        CategoryRating.update({
+            CategoryRating.next_global_category_rank: CategoryRating.global_category_rank,
+            CategoryRating.next_universe_category_rank: CategoryRating.universe_category_rank,
+            CategoryRating.next_category_score: CategoryRating.category_score
+        }).execute()
+
+
+def create_leaderboards():
+    overall = (GlobalRating
+               .select(Character.id, Character.name, Character.character_picture, Character.occupation,
+                       Character.official, Character.universe, GlobalRating.global_rank, GlobalRating.universe_rank,
+                       GlobalRating.overall_score.alias('score'))
+               .join(Character))
+    category = (CategoryRating
+                .select(Character.id, Character.name, Character.character_picture, Character.occupation,
+                        Character.official, CategoryRating.category, Category.name.alias('category_name'),
+                        CategoryRating.global_category_rank, CategoryRating.universe_category_rank,
+                        CategoryRating.category_score.alias('score'))
+                .join(Character)
+                .switch(CategoryRating)
+                .join(Category))
+    for model, query in ((OverallLeaderboard, overall), (CategoryLeaderboard, category)):
+        sql, params = query.sql()
+        DATABASE.execute_sql(f'CREATE MATERIALIZED VIEW IF NOT EXISTS "{model._meta.table_name}" AS {sql}', params)
+        model._schema.create_indexes(safe=True)
+
+
+def create_trigram_indexes():
+    # The searches use "ILIKE '%query%'", a normal index can't help with that, but a trigram index can.
+    DATABASE.execute_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for model, field in ((Character, Character.name), (Character, Character.species), (Character, Character.occupation),
+                         (Universe, Universe.name)):
+        table_name = model._meta.table_name
+        DATABASE.execute_sql(f'CREATE INDEX IF NOT EXISTS "{table_name.lower()}_{field.column_name}_trigram" '
+                             f'ON "{table_name}" USING gin ("{field.column_name}" gin_trgm_ops)')
+
+
+def add_numeric_attributes():
+    fields = [getattr(Character, f'{name}_{column}') for name in ('age', 'height', 'weight')
+              for column in ('number', 'open_ended', 'unknown', 'infinite')]
+    # The existing characters have to be parsed once, after that they're kept up to date when characters are saved.
+    if _add_missing_columns(Character, fields):
+        for name in ('age', 'height', 'weight'):
+            _backfill_numeric_attribute(name)
+    Character._schema.create_indexes(safe=True)
+
+
+def _backfill_numeric_attribute(name: str):
+    # A lot of characters share the same values, so every distinct value is parsed once and all the characters with it
+    # are updated together, in one statement for the whole table.
+    column = getattr(Character, name)
+    rows = []
+    for value, in Character.select(column).distinct().where(column.is_null(False)).tuples():
+        columns = Character.numeric_attribute_columns(**{name: value})
+        rows.append((value, columns[f'{name}_number'], columns[f'{name}_open_ended'], columns[f'{name}_unknown'],
+                     columns[f'{name}_infinite']))
+    if not rows:
+        return
+    parsed = ValuesList(rows, columns=('value', 'number', 'open_ended', 'unknown', 'infinite'), alias='parsed')
+    Character.update({
+        # A column of nothing but NULLs would be text otherwise.
+        getattr(Character, f'{name}_number'): parsed.c.number.cast('double precision'),
+        getattr(Character, f'{name}_open_ended'): parsed.c.open_ended,
+        getattr(Character, f'{name}_unknown'): parsed.c.unknown,
+        getattr(Character, f'{name}_infinite'): parsed.c.infinite
+    }).from_(parsed).where(column == parsed.c.value).execute()
+
+
+def create_search_name_triggers():
+    # The search names used to be set by the code everywhere a name was saved, now the database does it by itself.
+    DATABASE.execute_sql(f"""CREATE OR REPLACE FUNCTION update_search_name() RETURNS trigger AS $$
+                             BEGIN
+                                 NEW.search_name := to_tsvector('{SEARCH_CONFIGURATION}', NEW.name);
+                                 RETURN NEW;
+                             END
+                             $$ LANGUAGE plpgsql""")
+    for model in (Character, Universe):
+        table_name = model._meta.table_name
+        trigger_name = f'{table_name.lower()}_search_name'
+        if not DATABASE.execute_sql('SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = %s::regclass',
+                                    (trigger_name, f'"{table_name}"')).fetchone():
+            DATABASE.execute_sql(f'CREATE TRIGGER "{trigger_name}" BEFORE INSERT OR UPDATE OF name, search_name '
+                                 f'ON "{table_name}" FOR EACH ROW EXECUTE PROCEDURE update_search_name()')
+            # Saving the names again makes the trigger build all the search names with the same configuration.
+            model.update({model.name: model.name}).execute()
+        model._schema.create_indexes(safe=True)
+
+
+def add_comment_like_counts():
+    # The like counts start at zero, so they have to be counted from the likes that already exist.
+    if _add_missing_columns(Comment, [Comment.like_count]):
+        Comment.recount_like_counts()
+
+
+def _add_missing_columns(model, fields):
+    # Returns whether any of the columns were missing.
+    columns = {column_metadata.name for column_metadata in DATABASE.get_columns(model._meta.table_name)}
+    missing_fields = [field for field in fields if field.column_name not in columns]
+    migrator = PostgresqlMigrator(DATABASE)
+    for field in missing_fields:
+        migrate(migrator.add_column(model._meta.table_name, field.column_name, field))
+    return bool(missing_fields)
+
+
+MIGRATIONS = [
+    create_rating_change_table,
+    convert_scores_to_numbers,
+    create_rating_indexes,
+    add_vote_totals,
+    add_ratings_job,
+    create_leaderboards,
+    create_trigram_indexes,
+    add_numeric_attributes,
+    create_search_name_triggers,
+    add_comment_like_counts
+]
+
+
+def run_migrations():
+    for migration in MIGRATIONS:
+        with DATABASE.transaction():
+            migration()
+
+
+if __name__ == '__main__':
+    DATABASE.connect()
+    run_migrations()
+    DATABASE.close()
@@ -1,3 +1,6 @@
+from collections import Counter
+from threading import local
+
 from flask_login import UserMixin
 from google.cloud import storage
 from peewee import *
@@ -6,11 +9,36 @@ from playhouse.postgres_ext import TSVectorField
 
 from config import DATABASE_PASSWORD, DATABASE_USER, MAX_CONNECTIONS, STALE_TIMEOUT, DATABASE_NAME, DATABASE_HOST
 from main import login_manager
+from numeric_attributes import parse_numeric_attribute
+
+# The names are searched word by word, without stemming them like english words, since most of them are japanese.
+SEARCH_CONFIGURATION = 'simple'
 
 client = storage.Client()
 bucket = client.get_bucket('topanimecharacters.com')
 
-DATABASE = PooledPostgresqlDatabase(database=DATABASE_NAME, max_connections=MAX_CONNECTIONS, stale_timeout=STALE_TIMEOUT, user=DATABASE_USER, password=DATABASE_PASSWORD, host=DATABASE_HOST)
+class GuardedPostgresqlDatabase(PooledPostgresqlDatabase):
+    """Can refuse to run any query in the current thread, that's how templates that query the database while they're
+    rendered get caught in debug mode (look in central/routes.py)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._guard = local()
+
+    def forbid_queries(self, reason):
+        self._guard.reason = reason
+
+    def allow_queries(self):
+        self._guard.reason = None
+
+    def execute_sql(self, sql, *args, **kwargs):
+        reason = getattr(self._guard, 'reason', None)
+        if reason:
+            raise RuntimeError(f'{reason}, but this query was run: {sql}')
+        return super().execute_sql(sql, *args, **kwargs)
+
+
+DATABASE = GuardedPostgresqlDatabase(database=DATABASE_NAME, max_connections=MAX_CONNECTIONS, stale_timeout=STALE_TIMEOUT, user=DATABASE_USER, password=DATABASE_PASSWORD, host=DATABASE_HOST)
 
 
 class User(UserMixin, Model):
@@ -89,12 +117,13 @@ class CharacterTemp(Model):
 
 class Universe(Model):
     name = CharField(unique=True)
-    search_name = TSVectorField()
+    # Kept up to date by a trigger in the database whenever the name changes (look at migrations.py), don't set it.
+    search_name = TSVectorField(index=True)
 
     @classmethod
     def create_universe(cls, name: str):
         with DATABASE.transaction():
-            universe = cls.create(name=name, search_name=fn.to_tsvector(name))
+            universe = cls.create(name=name)
         return universe
 
     class Meta:
@@ -105,7 +134,8 @@ class Universe(Model):
 class Character(Model):
     user = ForeignKeyField(null=True, model=User, backref='characters', on_delete='SET NULL')
     name = CharField()
-    search_name = TSVectorField()
+    # Kept up to date by a trigger in the database whenever the name changes (look at migrations.py), don't set it.
+    search_name = TSVectorField(index=True)
     universe = ForeignKeyField(null=True, model=Universe, backref='characters', on_delete='CASCADE')
     character_picture = CharField(null=True)
     age = CharField()
@@ -118,6 +148,20 @@ class Character(Model):
     description = TextField()
     official = BooleanField()
     user_striked = BooleanField(default=False)
+    # The age, height and weight parsed (look at numeric_attribute_columns), so the filter search can use indexes and
+    # search for ranges. The number is NULL when it's unknown or infinite.
+    age_number = DoubleField(null=True)
+    age_open_ended = BooleanField(default=False)
+    age_unknown = BooleanField(default=False)
+    age_infinite = BooleanField(default=False)
+    height_number = DoubleField(null=True)
+    height_open_ended = BooleanField(default=False)
+    height_unknown = BooleanField(default=False)
+    height_infinite = BooleanField(default=False)
+    weight_number = DoubleField(null=True)
+    weight_open_ended = BooleanField(default=False)
+    weight_unknown = BooleanField(default=False)
+    weight_infinite = BooleanField(default=False)
 
     @classmethod
     def create_character(cls, name, universe, age, height, weight, species, gender, occupation, status,
@@ -125,7 +169,6 @@ class Character(Model):
         with DATABASE.transaction():
             character = cls.create(
                 name=name,
-                search_name=fn.to_tsvector(name),
                 universe=universe,
                 age=age,
                 height=height,
@@ -136,13 +179,33 @@ class Character(Model):
                 status=status,
                 description=description,
                 official=official,
-                user=user
+                user=user,
+                **cls.numeric_attribute_columns(age=age, height=height, weight=weight)
             )
         return character
 
+    @staticmethod
+    def numeric_attribute_columns(**attributes):
+        # e.g. numeric_attribute_columns(age="100+") gives {"age_number": 100.0, "age_open_ended": True, ...}, anything
+        # that can't be parsed is stored as neither a number, unknown nor infinite.
+        columns = {}
+        for name, value in attributes.items():
+            parsed = parse_numeric_attribute(value) or {'number': None, 'open_ended': False, 'unknown': False,
+                                                        'infinite': False}
+            columns.update({f'{name}_{key}': parsed_value for key, parsed_value in parsed.items()})
+        return columns
+
     class Meta:
         database = DATABASE
         table_name = "Character"
+        # The unknown and infinite flags come first, so both "= 180" and "BETWEEN 150 AND 180" are ranges on the same
+        # index. The last one is for filtering on the gender, status and official together.
+        indexes = (
+            (('age_unknown', 'age_infinite', 'age_number', 'age_open_ended'), False),
+            (('height_unknown', 'height_infinite', 'height_number', 'height_open_ended'), False),
+            (('weight_unknown', 'weight_infinite', 'weight_number', 'weight_open_ended'), False),
+            (('gender', 'status', 'official'), False),
+        )
 
 
 class CategoryTemp(Model):
@@ -212,16 +275,23 @@ class CategoryRelationship(Model):
 
 class GlobalRating(Model):
     character = ForeignKeyField(model=Character, backref='global_rating', on_delete='CASCADE', unique=True)
-    global_rank = IntegerField(null=True)
-    universe_rank = IntegerField(null=True)
-    overall_score = CharField(null=True)
+    global_rank = IntegerField(null=True, index=True)
+    universe_rank = IntegerField(null=True, index=True)
+    overall_score = DecimalField(null=True, max_digits=6, decimal_places=3, index=True)
+    # Running totals of every vote the character got, kept up to date whenever someone votes so the cron job never
+    # has to read the votes themselves.
+    vote_count = IntegerField(default=0)
+    score_sum = IntegerField(default=0)
+    # The ratings job works on these, and copies them over to the ones above all at once when it's done. That way
+    # nobody ever sees half updated ranks.
+    next_global_rank = IntegerField(null=True)
+    next_universe_rank = IntegerField(null=True)
+    next_overall_score = DecimalField(null=True, max_digits=6, decimal_places=3)
 
     @classmethod
-    def create_global_rating(cls, character: Character):
-        with DATABASE.transaction():
-            cls.create(
-                character=character
-            )
+    def create_global_ratings(cls, rows: list):
+        # Every row is a dict with at least the character, see "_create_or_update_many".
+        _create_or_update_many(cls, rows, conflict_target=[cls.character])
 
     class Meta:
         database = DATABASE
@@ -231,26 +301,118 @@ class GlobalRating(Model):
 class CategoryRating(Model):
     character = ForeignKeyField(model=Character, on_delete='CASCADE')
     category = ForeignKeyField(model=Category, on_delete='CASCADE')
-    global_category_rank = IntegerField(null=True)
-    universe_category_rank = IntegerField(null=True)
-    category_score = CharField(null=True)
+    global_category_rank = IntegerField(null=True, index=True)
+    universe_category_rank = IntegerField(null=True, index=True)
+    category_score = DecimalField(null=True, max_digits=6, decimal_places=3, index=True)
+    vote_count = IntegerField(default=0)
+    score_sum = IntegerField(default=0)
+    next_global_category_rank = IntegerField(null=True)
+    next_universe_category_rank = IntegerField(null=True)
+    next_category_score = DecimalField(null=True, max_digits=6, decimal_places=3)
 
     @classmethod
-    def create_category_rating(cls, character: Character, category: Category):
+    def create_category_ratings(cls, rows: list):
+        # Every row is a dict with at least the character and the category, see "_create_or_update_many".
+        _create_or_update_many(cls, rows, conflict_target=[cls.character, cls.category])
+
+    class Meta:
+        database = DATABASE
+        table_name = "Category_rating"
+        indexes = (
+            (('character', 'category'), True),
+        )
+
+
+class RatingChange(Model):
+    # There are no foreign keys here on purpose, a change has to outlive the character/universe it belongs to so the
+    # ranks of every other character still get updated. A change without a character means the whole universe changed.
+    universe_id = IntegerField()
+    character_id = IntegerField(null=True)
+    category_id = IntegerField(null=True)
+    # Claimed changes belong to the ratings job that is running right now.
+    claimed = BooleanField(default=False)
+
+    @classmethod
+    def create_rating_change(cls, universe_id: int, character_id=None, category_id=None):
         with DATABASE.transaction():
             cls.create(
-                character=character,
-                category=category
+                universe_id=universe_id,
+                character_id=character_id,
+                category_id=category_id
             )
 
     class Meta:
         database = DATABASE
-        table_name = "Category_rating"
+        table_name = "Rating_change"
+
+
+class RatingsJob(Model):
+    # There is only ever one row in here, it's the checkpoint of the ratings job so the next cron job request can
+    # continue where the last one stopped.
+    phase = CharField(null=True)
+    universe_cursor = IntegerField(default=0)
+
+    class Meta:
+        database = DATABASE
+        table_name = "Ratings_job"
+
+
+class OverallLeaderboard(Model):
+    # A materialized view and not a table (see "create_leaderboards" in migrations.py), refreshed by the ratings job.
+    # It has everything a leaderboard page shows, so a page is a single index scan.
+    id = IntegerField(primary_key=True)  # the id of the character
+    name = CharField()
+    character_picture = CharField(null=True)
+    occupation = CharField()
+    official = BooleanField()
+    universe_id = IntegerField()
+    global_rank = IntegerField(null=True)
+    universe_rank = IntegerField(null=True)
+    score = DecimalField(null=True, max_digits=6, decimal_places=3)
+
+    class Meta:
+        database = DATABASE
+        table_name = "Overall_leaderboard"
         indexes = (
-            (('character', 'category'), True),
+            # Refreshing a materialized view concurrently needs a unique index.
+            (('id',), True),
+            (('universe_id', 'universe_rank', 'id'), False),
         )
 
 
+OverallLeaderboard.add_index(OverallLeaderboard.index(OverallLeaderboard.global_rank, OverallLeaderboard.id)
+                             .where(OverallLeaderboard.official))
+
+
+class CategoryLeaderboard(Model):
+    # A materialized view too, just like the one above.
+    id = IntegerField()  # the id of the character
+    name = CharField()
+    character_picture = CharField(null=True)
+    occupation = CharField()
+    official = BooleanField()
+    category_id = IntegerField()
+    category_name = CharField()
+    global_category_rank = IntegerField(null=True)
+    universe_category_rank = IntegerField(null=True)
+    score = DecimalField(null=True, max_digits=6, decimal_places=3)
+
+    class Meta:
+        database = DATABASE
+        table_name = "Category_leaderboard"
+        primary_key = CompositeKey('id', 'category_id')
+        indexes = (
+            # Refreshing a materialized view concurrently needs a unique index.
+            (('id', 'category_id'), True),
+            (('category_id', 'universe_category_rank', 'id'), False),
+        )
+
+
+CategoryLeaderboard.add_index(CategoryLeaderboard.index(CategoryLeaderboard.category_name,
+                                                        CategoryLeaderboard.global_category_rank,
+                                                        CategoryLeaderboard.id).where(CategoryLeaderboard.official))
+
+
 class CharacterTempPicture(Model):
     user = ForeignKeyField(null=True, model=User, backref='temp_pictures', on_delete='SET NULL')
     character = ForeignKeyField(model=Character, backref='temp_pictures', on_delete='CASCADE')
@@ -295,6 +457,8 @@ class Comment(Model):
     modified = DateTimeField()
     parent = ForeignKeyField('self', null=True, backref='comments', on_delete='CASCADE')
     content = TextField()
+    # The amount of likes (CommentRelationship rows) of the comment, kept up to date when they're created and deleted.
+    like_count = IntegerField(default=0)
 
     @classmethod
     def create_comment(cls, character, user, parent, content, created):
@@ -309,6 +473,16 @@ class Comment(Model):
             )
         return comment
 
+    @classmethod
+    def recount_like_counts(cls):
+        # Counts the likes again from the likes themselves, in case they ever got out of sync.
+        like_counts = (cls
+                       .select(cls.id, fn.COUNT(CommentRelationship.id).alias('like_count'))
+                       .join(CommentRelationship, JOIN.LEFT_OUTER, on=(CommentRelationship.to_comment == cls.id))
+                       .group_by(cls.id))
+        cls.update({cls.like_count: like_counts.c.like_count}).from_(like_counts).where(
+            cls.id == like_counts.c.id).execute()
+
     class Meta:
         database = DATABASE
         table_name = "Comment"
@@ -339,6 +513,22 @@ class CommentRelationship(Model):
     def create_comment_relationship(cls, from_user, to_comment):
         with DATABASE.transaction():
             cls.create(from_user=from_user, to_comment=to_comment)
+            Comment.update({Comment.like_count: Comment.like_count + 1}).where(Comment.id == to_comment).execute()
+
+    @classmethod
+    def delete_comment_relationships(cls, condition):
+        # Only the likes that really got deleted are taken off the like counts, so two requests deleting the same like
+        # at the same time don't both count it. Returns how many likes were deleted.
+        with DATABASE.transaction():
+            deleted_likes = Counter(row[0] for row in cls.delete().where(condition).returning(cls.to_comment).tuples()
+                                    .execute())
+            comments_by_amount = {}
+            for comment_id, amount in deleted_likes.items():
+                comments_by_amount.setdefault(amount, []).append(comment_id)
+            for amount, comment_ids in comments_by_amount.items():
+                Comment.update({Comment.like_count: Comment.like_count - amount}).where(
+                    Comment.id << comment_ids).execute()
+        return sum(deleted_likes.values())
 
     class Meta:
         database = DATABASE
@@ -348,6 +538,22 @@ class CommentRelationship(Model):
         )
 
 
+def _create_or_update_many(model, rows: list, conflict_target: list):
+    # Creates all the rows in a single statement. The rows that exist already gets the other values of the row instead,
+    # or are just left alone if there aren't any other values.
+    if not rows:
+        return
+    values_to_update = [getattr(model, name) for name in rows[0]
+                        if name not in [field.name for field in conflict_target]]
+    with DATABASE.transaction():
+        query = model.insert_many(rows)
+        if values_to_update:
+            query = query.on_conflict(conflict_target=conflict_target, preserve=values_to_update)
+        else:
+            query = query.on_conflict_ignore()
+        query.execute()
+
+
 def upload_image(file, path: str):
     file_stream = file.read()
     content_type = file.content_type
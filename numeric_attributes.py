@@ -0,0 +1,60 @@
+import re
+
+# The ages, heights and weights of the characters are parsed in here. Nothing of the app is imported, since the models
+# use it too.
+
+
+def strip_zeros(user_input):
+    if user_input is not None and len(user_input):
+        if user_input == 'infinite' or user_input == 'unknown':
+            return user_input
+        first_char = [user_input[0], False]
+        last_char = [user_input[-1], False]
+        if first_char[0] == '-':
+            user_input = user_input[1:]
+            first_char[1] = True
+        if last_char[0] == '+':
+            last_char[1] = True
+            user_input = user_input[:-1]
+        if '.' in user_input:
+            proper_input = user_input.strip('0')
+            if proper_input[-1] == '.':
+                proper_input = proper_input[:-1]
+        else:
+            proper_input = user_input.lstrip('0')
+        if first_char[1]:
+            proper_input = f"{'-'}{proper_input}"
+        if last_char[1]:
+            proper_input = f"{proper_input}{'+'}"
+        return proper_input
+    return user_input
+
+
+# strip_zeros turns 0 into "", 0.5 into ".5" and 0+ into "+", so the digits before the "." can be missing.
+_NUMERIC_ATTRIBUTE = re.compile(r'^(-?\d*(?:\.\d+)?)(\+?)$')
+_NUMERIC_RANGE = re.compile(r'^(-?\d*\.?\d+)\s*(?:-|–|to)\s*(-?\d*\.?\d+)$', re.IGNORECASE)
+
+
+def parse_numeric_attribute(user_input):
+    """Splits an age, height or weight like "934.8", "100+", "Unknown" or "Infinite" into the number, whether it's
+    open ended (the "+"), and whether it's unknown or infinite. Returns None if it's none of those."""
+    if user_input is None:
+        return None
+    user_input = strip_zeros(user_input.strip())
+    if user_input.lower() in ('unknown', 'infinite'):
+        return {'number': None, 'open_ended': False, 'unknown': user_input.lower() == 'unknown',
+                'infinite': user_input.lower() == 'infinite'}
+    match = _NUMERIC_ATTRIBUTE.match(user_input)
+    if not match:
+        return None
+    number = match.group(1)
+    return {'number': float(number) if number.strip('-') else 0.0, 'open_ended': bool(match.group(2)), 'unknown': False,
+            'infinite': False}
+
+
+def parse_numeric_range(user_input):
+    # "150-180", "150 - 180" or "150 to 180", returns the lowest and the highest number or None.
+    match = _NUMERIC_RANGE.match(user_input.strip())
+    if not match:
+        return None
+    return tuple(sorted(float(number) for number in match.groups()))
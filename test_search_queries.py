@@ -0,0 +1,93 @@
+import os
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+# The app has to be set up first, the models and the blueprints import each other through it.
+from main import app
+import characters.routes
+from benchmark_ratings import StatementCounter
+from characters.ratings import update_all_ratings
+from characters.search_cache import SEARCH_CACHE
+from config import DATABASE_NAME, MAX_CONNECTIONS, STALE_TIMEOUT
+from migrations import run_migrations
+from models import DATABASE, CharacterTemp, User, Character, Comment, CommentRelationship, Ping, \
+    CharacterTempPicture, CharacterPicture, Universe, Category, CategoryRelationship, CategoryTemp, GlobalRating, \
+    CategoryRating, RatingChange, RatingsJob
+
+# Checks that a page of search results takes the same amount of statements whatever the page size, so nothing gets
+# loaded per character again. Run it like this: "TEST_DATABASE=anime_test python -m unittest test_search_queries".
+# The database has to exist already, and EVERYTHING in it gets deleted, so never point it at a real one!
+TEST_DATABASE = os.environ.get('TEST_DATABASE')
+PAGE_SIZES = (1, 10, 50)
+MODELS = [User, CharacterTemp, Character, Comment, CommentRelationship, Ping, CharacterTempPicture, CharacterPicture,
+          Universe, Category, CategoryRelationship, CategoryTemp, GlobalRating, CategoryRating, RatingChange,
+          RatingsJob]
+
+
+def seed(characters: int):
+    # The leaderboards are dropped together with the tables (cascade), the migrations create them again.
+    DATABASE.drop_tables(MODELS, cascade=True)
+    DATABASE.create_tables(MODELS)
+    run_migrations()
+    now = datetime.now()
+    users = [User.create(username=f'user {i}', email=f'user{i}@test', password='test', joined_at=now,
+                         current_log_in=now, email_confirmed=True) for i in range(3)]
+    universes = [Universe.create(name=f'Universe {i}') for i in range(3)]
+    categories = {universe.id: [Category.create(universe=universe, name=name) for name in ('Strength', 'Speed')]
+                  for universe in universes}
+    for i in range(characters):
+        universe = universes[i % len(universes)]
+        character = Character.create(name=f'Character {i}', universe=universe, age='1', height='1', weight='1',
+                                     species='Human', gender='Male', occupation='-', status='Alive',
+                                     description='-', official=i % 3 != 0,
+                                     **Character.numeric_attribute_columns(age='1', height='1', weight='1'))
+        GlobalRating.create_global_ratings([{'character': character}])
+        CategoryRating.create_category_ratings([{'character': character, 'category': category}
+                                                for category in categories[universe.id]])
+        for j, user in enumerate(users):
+            CategoryRelationship.create(character=character, user=user, category=categories[universe.id][j % 2],
+                                        score=(i * 7 + j * 13) % 101)
+    # This counts the vote totals from the votes too.
+    update_all_ratings()
+
+
+@unittest.skipUnless(TEST_DATABASE, 'TEST_DATABASE is not set to a throwaway database')
+class SearchQueryCountTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if TEST_DATABASE == DATABASE_NAME:
+            raise unittest.SkipTest("That's the database of the website, please use a throwaway one instead.")
+        DATABASE.init(TEST_DATABASE, max_connections=MAX_CONNECTIONS, stale_timeout=STALE_TIMEOUT)
+        with DATABASE.connection_context():
+            # Enough characters for the second page of the biggest page size.
+            seed(characters=max(PAGE_SIZES) * 3)
+        cls.counter = StatementCounter(DATABASE)
+        cls.client = app.test_client()
+        # The first request builds the index of the live search, that shouldn't be counted.
+        cls.client.get('/')
+
+    def count_statements(self, url: str, page_size: int):
+        with patch.object(characters.routes, 'CHARACTER_ONLY_SEARCH_AMOUNT', page_size):
+            SEARCH_CACHE.clear()
+            self.counter.reset()
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()['characters']), page_size)
+        return self.counter.queries
+
+    def assert_same_count_for_every_page_size(self, url: str):
+        counts = {page_size: self.count_statements(url, page_size) for page_size in PAGE_SIZES}
+        self.assertEqual(len(set(counts.values())), 1, f'The statements of {url} by page size: {counts}')
+
+    def test_character_search(self):
+        self.assert_same_count_for_every_page_size(
+            '/character_search?query=Character&search_category_toggle=characters&page=1')
+
+    def test_character_filter_search(self):
+        self.assert_same_count_for_every_page_size('/character_filter_search?name=Character&page=1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,12 @@ from flask import Blueprint, flash, redirect, url_for, render_template, jsonify,
 from flask_login import login_required, logout_user, login_user
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 
+from characters.ratings import mark_votes_of_user_changed, subtract_votes_from_totals
+from characters.utils import forget_comment_users
 from mails import send_confirmation_email, send_account_deletion_mail, email_confirmation_resend, \
     send_password_reset_email, send_to_us
 from main import limiter, hashing, app
-from models import User, delete_image, upload_image
+from models import DATABASE, User, delete_image, upload_image, CommentRelationship, CategoryRelationship
 from users.forms import DeleteForm, LoginForm, RegisterForm, EmailFormForEmailChange, ResetPasswordWithTokenForm, \
     ResetPasswordForm, UsernameForm, ProfilePictureForm, EmailFormForPasswordReset, AuthenticatedContactForm, \
     PublicContactForm, EmailSettings
@@ -115,7 +117,14 @@ def delete_account():
         if hashing.check_password_hash(g.user.password, form.current_password.data):
             if g.user.profile_picture[app.config['LEN_OF_PATH_OF_PROFILE_PIC']:] != 'default':  # delete only if the picture isn't the default picture
                 delete_image(g.user.profile_picture)
-            g.user.delete_instance()
+            # The likes would be deleted together with the user anyway, but then the like counts wouldn't know.
+            CommentRelationship.delete_comment_relationships(CommentRelationship.from_user == g.user.id)
+            with DATABASE.transaction():
+                # The votes are deleted together with the user too, so they have to leave the vote totals first.
+                mark_votes_of_user_changed(g.user.id)
+                subtract_votes_from_totals(CategoryRelationship.user == g.user.id)
+                g.user.delete_instance()
+            forget_comment_users()
             send_account_deletion_mail(g.user.email, g.user.username)
             logout_user()
             flash(message="Your user account has been deleted. It's sad but it's true :(", category="success")
@@ -15,6 +15,7 @@ from wtforms.validators import ValidationError, StopValidation
 
 from config import ALLOWED_FILE_EXTENSIONS
 from main import app
+from numeric_attributes import strip_zeros
 
 # If huge malicious files comes in, they will be interpreted as an error, hopefully...
 
@@ -121,32 +122,6 @@ def strip_filter(value):
     return value
 
 
-def strip_zeros(user_input):
-    if user_input is not None and len(user_input):
-        if user_input == 'infinite' or user_input == 'unknown':
-            return user_input
-        first_char = [user_input[0], False]
-        last_char = [user_input[-1], False]
-        if first_char[0] == '-':
-            user_input = user_input[1:]
-            first_char[1] = True
-        if last_char[0] == '+':
-            last_char[1] = True
-            user_input = user_input[:-1]
-        if '.' in user_input:
-            proper_input = user_input.strip('0')
-            if proper_input[-1] == '.':
-                proper_input = proper_input[:-1]
-        else:
-            proper_input = user_input.lstrip('0')
-        if first_char[1]:
-            proper_input = f"{'-'}{proper_input}"
-        if last_char[1]:
-            proper_input = f"{proper_input}{'+'}"
-        return proper_input
-    return user_input
-
-
 def _is_not_equal_to_tac(form, field: StringField):
     if field.data.lower() == 'top anime characters':
         raise ValidationError("The category \"Top Anime Characters\" is a reserved category, please choose another. ")